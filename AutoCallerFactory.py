@@ -1,56 +1,230 @@
 import math
-from datetime import datetime
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 import logging
+from typing import Awaitable, Callable, Hashable
 
-from downloader import APILimitException, NotFound, downloader_classes
+from downloader import APILimitException, NotFound, Transfer, downloader_classes, http_pool
 from dataHandle import ItemInfo, ItemLocation, Data
 from configHandle import config
+from Metrics import CACHE_REQUESTS, COALESCED_REQUESTS, FETCH_SECONDS, INFLIGHT_FETCHES, UPSTREAM_ERRORS
+
+
+class SingleFlight:
+    """同一个键同时只执行一次，并发的调用者等待同一个结果"""
+    __slots__ = ("logger", "_flights")
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # 键 -> [共享的 future, 合并的等待者数量]
+        self._flights: dict[Hashable, list] = {}
+
+    def join(self, key: Hashable, func: Callable[[], Awaitable]) -> asyncio.Future:
+        """没有进行中的调用则用 func 发起，否则加入已有的调用，返回共享的 future"""
+        flight = self._flights.get(key)
+        if flight:
+            flight[1] += 1
+            COALESCED_REQUESTS.inc()
+            return flight[0]
+
+        future = asyncio.ensure_future(func())
+        flight = self._flights[key] = [future, 0]
+        future.add_done_callback(lambda _: self._land(key, flight))
+        return future
+
+    def _land(self, key: Hashable, flight: list):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if flight[1]:
+            self.logger.info(f"coalesced {flight[1]} waiters for {key}")
 
 
 class AllocateDownloader:
-    """调度下载器，不对外抛出下载器的异常"""
-    __slots__ = ("logger", "data", "download_dir")
+    """调度下载器，不对外抛出下载器的异常。进程内用 SingleFlight 合并，进程间用数据库里的租约，同一个下载项同时只有一处访问上游"""
+    __slots__ = ("logger", "data", "download_dir", "single_flight", "transfers", "site_slots")
+    lease_ttl = 60   # 租约的有效期（秒），持有期间每隔三分之一续期，进程意外退出后过期即可被别的进程取得
+    lease_poll = 0.5   # 租约被其他进程持有时，隔这么久（秒）再试
 
     def __init__(self, data: Data, download_dir):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.data = data
         self.download_dir = download_dir
+        self.single_flight = SingleFlight()
+        self.transfers: dict[ItemLocation, Transfer] = {}   # 正在进行的上游下载
+        self.site_slots: dict[str, set[str]] = {}   # website -> 本进程持有的名额租约
 
-    async def get_file(self, item_info: ItemInfo):
-        item_location = ItemLocation(item_info.name, item_info.platform, item_info.arch)
-        filepath = self.data.get_and_check_path_from_db(item_location)
-        if item_info.last_modified and AllocateDownloader.ceil_days_diff(datetime.now(), item_info.last_modified) > item_info.staleDurationDay:
+    @staticmethod
+    def is_stale(item_info: ItemInfo) -> bool:
+        # 检查时间和 db_now 一样是不带时区的 UTC 时间
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return bool(item_info.last_modified) and AllocateDownloader.ceil_days_diff(now, item_info.last_modified) > item_info.staleDurationDay
+
+    async def _get_fresh_path(self, item_info: ItemInfo) -> tuple[str, str]:
+        """返回未过期的缓存文件的路径和文件名"""
+        if AllocateDownloader.is_stale(item_info):
             self.logger.info(f"need check new version for '{item_info.name}'.")
-            filepath = ""
+            CACHE_REQUESTS.labels(item_info.website, item_info.name, "stale").inc()
+            return "", ""
+        item_location = ItemLocation(item_info.name, item_info.platform, item_info.arch)
+        filepath, filename = await self.data.get_and_check_path_from_db(item_location)
+        CACHE_REQUESTS.labels(item_info.website, item_info.name, "hit" if filepath else "miss").inc()
+        return filepath, filename
+
+    def _fetch(self, item_info: ItemInfo) -> asyncio.Future:
+        """发起或加入该下载项的上游工作"""
+        item_location = ItemLocation(item_info.name, item_info.platform, item_info.arch)
+
+        def start():
+            transfer = self.transfers[item_location] = Transfer()
+            return self._call_instance(item_info, transfer)
+        return self.single_flight.join(item_location, start)
+
+    async def get_file(self, item_info: ItemInfo) -> tuple[str, str]:
+        """返回文件的路径和给客户端的文件名"""
+        filepath, filename = await self._get_fresh_path(item_info)
+        if filepath:
+            return filepath, filename
+        await asyncio.shield(self._fetch(item_info))
+        return await self.data.get_and_check_path_from_db(ItemLocation(item_info.name, item_info.platform, item_info.arch))
+
+    async def get_file_or_transfer(self, item_info: ItemInfo) -> tuple[str, str, Transfer | None]:
+        """同 get_file，但若需要从上游下载，一旦开始写文件就返回进行中的 transfer，供客户端边下边读"""
+        filepath, filename = await self._get_fresh_path(item_info)
         if filepath:
-            return filepath
-        await self._call_instance(item_info)
-        return self.data.get_and_check_path_from_db(item_location)
+            return filepath, filename, None
+        item_location = ItemLocation(item_info.name, item_info.platform, item_info.arch)
+        future = self._fetch(item_info)
+        transfer = self.transfers.get(item_location)
+        if transfer and not future.done():
+            started = asyncio.ensure_future(transfer.wait_started())
+            await asyncio.wait((future, started), return_when=asyncio.FIRST_COMPLETED)
+            started.cancel()
+            if transfer.started and not transfer.failed and not future.done():
+                return "", transfer.filename, transfer
+        await asyncio.shield(future)
+        return *(await self.data.get_and_check_path_from_db(item_location)), None
+
+    def check_later(self, item_info: ItemInfo):
+        """在后台检查新版本，有则下载，不等结果"""
+        self._fetch(item_info).add_done_callback(self._log_failure)
+
+    def _log_failure(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.warning(f"background check failed: {future.exception()}")
+
+    async def refresh(self, item_info: ItemInfo) -> str:
+        """不论是否过期，检查新版本，有则下载，返回检查的结果"""
+        return await asyncio.shield(self._fetch(item_info))
+
+    async def _call_instance(self, item: ItemInfo, transfer: Transfer) -> str:
+        outcome = "error"
+        start = time.perf_counter()
+        item_location = ItemLocation(item.name, item.platform, item.arch)
+        lease_key = "fetch:{}/{}/{}".format(*item_location)
+        INFLIGHT_FETCHES.inc()
+        try:
+            waited = await self._acquire_lease(lease_key)
+            renewal = asyncio.create_task(self._renew_lease(lease_key))
+            try:
+                await self.data.sync()   # 拿到租约前，其他进程可能刚更新了它
+                current = self.data.get_item_situation(item_location) or item
+                if waited and current.buf_id and not AllocateDownloader.is_stale(current):
+                    outcome = "done by another worker"
+                else:
+                    outcome = await self._run_instance(current, transfer)
+            finally:
+                renewal.cancel()
+                await self.data.release_lease(lease_key)
+            return outcome
+        finally:
+            INFLIGHT_FETCHES.dec()
+            FETCH_SECONDS.labels(item.website, outcome).observe(time.perf_counter() - start)
+            transfer.finish(False)   # 已经正常结束的不受影响
+            if self.transfers.get(item_location) is transfer:
+                del self.transfers[item_location]
+
+    async def _acquire_lease(self, lease_key: str) -> bool:
+        """等到取得租约，返回是否等待过其他进程"""
+        waited = False
+        while not await self.data.try_lease(lease_key, AllocateDownloader.lease_ttl):
+            waited = True
+            await asyncio.sleep(AllocateDownloader.lease_poll)
+        return waited
+
+    async def _renew_lease(self, lease_key: str):
+        while True:
+            await asyncio.sleep(AllocateDownloader.lease_ttl / 3)
+            if not await self.data.try_lease(lease_key, AllocateDownloader.lease_ttl):
+                self.logger.warning(f"lease {lease_key} was taken by another worker")
+
+    @asynccontextmanager
+    async def _website_slot(self, website: str):
+        """同一 website 所有进程合计同时进行的上游工作不超过 concurrent_amount_per_website：
+        进程内先按 http_pool 的信号量排队，再在数据库里取得这个 website 的一个名额"""
+        async with http_pool.limit(website):
+            lease_key = await self._acquire_slot(website)
+            renewal = asyncio.create_task(self._renew_lease(lease_key))
+            try:
+                yield
+            finally:
+                renewal.cancel()
+                self.site_slots[website].discard(lease_key)
+                await self.data.release_lease(lease_key)
+
+    async def _acquire_slot(self, website: str) -> str:
+        taken = self.site_slots.setdefault(website, set())
+        while True:
+            for i in range(http_pool.concurrent_amount):
+                lease_key = f"site:{website}:{i}"
+                if lease_key in taken:
+                    continue
+                taken.add(lease_key)   # 先占上，本进程的其他协程不会在等待数据库时试同一个名额
+                try:
+                    if await self.data.try_lease(lease_key, AllocateDownloader.lease_ttl):
+                        return lease_key
+                except BaseException:
+                    taken.discard(lease_key)
+                    raise
+                taken.discard(lease_key)
+            await asyncio.sleep(AllocateDownloader.lease_poll)
 
-    async def _call_instance(self, item: ItemInfo):
+    async def _run_instance(self, item: ItemInfo, transfer: Transfer) -> str:
         cls = downloader_classes.get(item.website)
         if not cls:
             self.logger.warning(f"No instance found with downloader_name '{item.website}'.")
-            return [], ""
-        instance = cls(self.download_dir)
+            return "no downloader"
+        instance = cls(self.download_dir, config.GithubAPI, self.data.find_blob_by_url)
 
         try:
-            fp, ver = await instance(item)
+            async with self._website_slot(item.website):
+                artifact, ver = await instance(item, transfer)
         except NotFound:
             self.logger.warning("Unable to find the corresponding resource based on the provided information")
+            UPSTREAM_ERRORS.labels(item.website, "not_found").inc()
+            return "not found"
         except APILimitException:
             self.logger.warning("API rate limit exceeded for machine IP")
+            UPSTREAM_ERRORS.labels(item.website, "api_limit").inc()
+            return "api limit"
         except Exception as e:
+            UPSTREAM_ERRORS.labels(item.website, "error").inc()
             await config.post2RSS("error log of AllocateDownloader", str(e))
             raise
         else:
-            # 有新版本或第一次下载，会返回新文件路径和版本
-            if fp and ver:
+            # 有新版本或第一次下载，会返回新文件和版本
+            if artifact and ver:
                 self.logger.info(f"there is a new version for {item.name}")
-                self.data.update_item_in_db(item, ver, fp)
-                self.data.check_and_handle_max_space()
+                await self.data.update_item_in_db(item, ver, artifact)
+                await self.data.check_and_handle_max_space(ItemLocation(item.name, item.platform, item.arch))
+                return "updated"
+            elif item.buf_id and not ver:   # 没有新版本，重新计算过期时间
+                await self.data.touch_checked(ItemLocation(item.name, item.platform, item.arch))
+                return "up to date"
             else:   # 有新版本但出错，会抛出异常；无更新或出错返回都为空
-                pass
+                UPSTREAM_ERRORS.labels(item.website, "download_failed").inc()
+                return "failed"
 
     @staticmethod
     def ceil_days_diff(dt1: datetime, dt2: datetime):
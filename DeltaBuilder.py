@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+
+from dataHandle import Data, get_delta_path
+from Metrics import DELTA_BUILDS
+
+
+class DeltaBuilder:
+    """下载到新版本后，在后台用 zstd --patch-from 算出从上一版本到它的补丁，已有上一版本的客户端只需下载补丁。
+    一次只算一个，多个进程时每个补丁由取得租约的那个进程计算。需要 zstd 命令，没有时不算补丁，客户端总是得到整个文件"""
+    poll_seconds = 60   # 至少这么久检查一次，接手其他进程没算完的
+    build_timeout = 1800   # 算一个补丁最长的时间（秒），也是租约的有效期
+    max_window_log = 31   # zstd 的窗口要能容纳整个旧文件，最大 2 GiB
+
+    def __init__(self, data: Data, download_dir: str, level: int, max_ratio: float):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.data = data
+        self.download_dir = download_dir
+        self.level = level
+        self.max_ratio = max_ratio
+        self.zstd = shutil.which("zstd")
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if not self.zstd:
+            self.logger.warning("zstd is not found, delta updates are disabled")
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self.logger.info("delta builder started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self.data.delta_pending.clear()
+            try:
+                for delta in await self.data.get_pending_deltas():
+                    await self._build(*delta)
+            except Exception as e:
+                self.logger.error(f"failed to build deltas: {e}")
+            try:
+                async with asyncio.timeout(DeltaBuilder.poll_seconds):
+                    await self.data.delta_pending.wait()
+            except TimeoutError:
+                pass
+
+    async def _build(self, id: int, from_path: str, from_size: int, to_path: str, to_size: int, from_hash: str, to_hash: str):
+        lease_key = f"delta:{id}"
+        if not await self.data.try_lease(lease_key, DeltaBuilder.build_timeout):
+            return
+        try:
+            try:
+                patch_path, size, patch_hash, outcome = await self._diff(from_path, from_size, to_path, to_size, from_hash, to_hash)
+            except Exception as e:   # 不再重试，这一版本的客户端下载整个文件
+                self.logger.warning(f"failed to diff {from_hash[:12]} -> {to_hash[:12]}: {e}")
+                patch_path, size, patch_hash, outcome = "", 0, "", "failed"
+            await self.data.finish_delta(id, patch_path, size, patch_hash)
+            DELTA_BUILDS.labels(outcome).inc()
+            self.logger.info(f"delta {from_hash[:12]} -> {to_hash[:12]}: {outcome}, {size} of {to_size} bytes")
+        finally:
+            await self.data.release_lease(lease_key)
+
+    async def _diff(self, from_path: str, from_size: int, to_path: str, to_size: int, from_hash: str, to_hash: str):
+        """返回补丁的路径、大小、哈希和结果，不用补丁时路径为空"""
+        window_log = max(max(from_size, to_size).bit_length(), 10)
+        if window_log > DeltaBuilder.max_window_log:
+            return "", 0, "", "too large"
+        patch_path = get_delta_path(self.download_dir, from_hash, to_hash)
+        part_path = patch_path + ".part"
+        await asyncio.to_thread(os.makedirs, os.path.dirname(patch_path), exist_ok=True)
+        args = [self.zstd, "-q", "-f", f"-{self.level}", f"--long={window_log}", f"--patch-from={from_path}", to_path, "-o", part_path]
+        if self.level > 19:
+            args.insert(1, "--ultra")
+        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        try:
+            async with asyncio.timeout(DeltaBuilder.build_timeout):
+                _, stderr = await proc.communicate()
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            await asyncio.to_thread(DeltaBuilder._remove, part_path)
+            raise
+        if proc.returncode != 0:
+            await asyncio.to_thread(DeltaBuilder._remove, part_path)
+            self.logger.warning(f"zstd exited with {proc.returncode}: {stderr.decode(errors='replace').strip()}")
+            return "", 0, "", "failed"
+        size, patch_hash = await asyncio.to_thread(DeltaBuilder._finish, part_path, patch_path)
+        if size >= to_size * self.max_ratio:   # 补丁省不了多少，直接下载整个文件
+            await asyncio.to_thread(DeltaBuilder._remove, patch_path)
+            return "", 0, "", "not worth it"
+        return patch_path, size, patch_hash, "built"
+
+    @staticmethod
+    def _finish(part_path: str, patch_path: str) -> tuple[int, str]:
+        hasher = hashlib.sha256()
+        with open(part_path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                hasher.update(chunk)
+        os.replace(part_path, patch_path)
+        return os.path.getsize(patch_path), hasher.hexdigest()
+
+    @staticmethod
+    def _remove(path: str):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,133 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, Response
+from jinja2 import Template
+
+from dataHandle import Data
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CachedPage:
+    """只在目录变动后重新生成一次的页面，同时存好压缩后的内容和校验值，之后的请求直接返回这些字节。
+    页面在事件循环里按目录生成，压缩较慢，放到线程里进行"""
+    __slots__ = ("logger", "generation", "encoded", "etag", "last_modified", "_last_modified_ts")
+    media_type = "text/plain; charset=utf-8"
+    # 浏览器每次都要校验，未变化时回 304
+    cache_control = "no-cache"
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.generation = -1
+        self.encoded: dict[str, bytes] = {}   # 编码 -> 内容，"identity" 为未压缩的
+        self.etag = ""
+        self.last_modified = ""
+        self._last_modified_ts = 0
+
+    async def response(self, request: Request, data: Data) -> Response:
+        if data.generation != self.generation:
+            await self._render(data)
+        encoding = self._choose_encoding(request.headers.get("accept-encoding", ""))
+        etag = self.etag if encoding == "identity" else f'"{self.etag[1:-1]}-{encoding}"'
+        headers = {"ETag": etag, "Last-Modified": self.last_modified, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if self._not_modified(request):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.encoded[encoding], media_type=self.media_type, headers=headers)
+
+    def build(self, data: Data) -> bytes:
+        raise NotImplementedError
+
+    async def _render(self, data: Data):
+        generation = data.generation
+        body = self.build(data)
+        encoded = await asyncio.to_thread(CachedPage._encode, body)
+        if generation < self.generation:   # 压缩期间另一个请求已经生成了更新的
+            return
+        self.encoded = encoded
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        if f'"{digest}"' != self.etag:   # 内容没变则保留原来的修改时间
+            self.etag = f'"{digest}"'
+            self._last_modified_ts = int(time.time())
+            self.last_modified = formatdate(self._last_modified_ts, usegmt=True)
+        self.generation = generation
+        self.logger.info(f"rendered for generation {generation}, {len(body)} bytes")
+
+    @staticmethod
+    def _encode(body: bytes) -> dict[str, bytes]:
+        encoded = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli:
+            encoded["br"] = brotli.compress(body)
+        return encoded
+
+    def _choose_encoding(self, accept_encoding: str) -> str:
+        accepted = set()
+        for part in accept_encoding.split(","):
+            coding, _, params = part.strip().partition(";")
+            if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(coding.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.encoded and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def _not_modified(self, request: Request) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            digest = self.etag[1:-1]
+            for tag in if_none_match.split(","):
+                tag = tag.strip().removeprefix("W/").strip('"')
+                if tag == "*" or tag == digest or tag.startswith(digest + "-"):
+                    return True
+            return False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self._last_modified_ts
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class IndexPage(CachedPage):
+    """首页"""
+    __slots__ = ("template", )
+    media_type = "text/html; charset=utf-8"
+
+    def __init__(self, template: Template):
+        super().__init__()
+        self.template = template
+
+    def build(self, data: Data) -> bytes:
+        return self.template.render(categories=data.categories).encode("utf-8")
+
+
+class ManifestPage(CachedPage):
+    """所有下载项已缓存的版本、大小和哈希，客户端带上 ETag 请求，没有变化时只得到 304，不必下载文件就知道有没有更新"""
+    __slots__ = ()
+    media_type = "application/json"
+
+    def build(self, data: Data) -> bytes:
+        items = [{
+            "name": r.name,
+            "platform": r.platform,
+            "arch": r.arch,
+            "version": r.version,
+            "filename": r.filename,
+            "size": r.size,
+            "sha256": r.blob_hash,
+            "last_modified": r.last_modified,
+            "link": r.formated_dl_url,
+        } for r in data.catalog.values()]
+        return json.dumps({"items": items}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# 缓存命中情况：hit 未过期直接返回，stale 过期需检查新版本，miss 尚未缓存
+CACHE_REQUESTS = Counter("uf_cache_requests_total", "Download requests by cache result", ["website", "item", "result"])
+# 抓取流水线每个阶段的耗时，download 包含下载前检查直链
+STAGE_SECONDS = Histogram("uf_stage_seconds", "Time spent in each stage of fetching from upstream", ["website", "stage"],
+                          buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+DOWNLOAD_BYTES = Histogram("uf_download_bytes", "Size of files downloaded from upstream", ["website"],
+                           buckets=tuple(2 ** n for n in range(16, 34, 2)))
+FETCH_SECONDS = Histogram("uf_fetch_seconds", "Time of a whole upstream check and download", ["website", "outcome"],
+                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+# 多进程时 Gauge 按 multiprocess_mode 汇总各进程的值
+# 查询上游最新版本时版本缓存的情况：hit 命中，miss 要查上游，joined 等待同一个项目进行中的查询
+VERSION_CACHE_REQUESTS = Counter("uf_version_cache_requests_total", "Latest-version lookups by version cache result", ["website", "result"])
+# 加入了进行中的上游工作、没有再访问上游的请求（包括后台检查）
+COALESCED_REQUESTS = Counter("uf_coalesced_requests_total", "Requests that joined an upstream check or download already in progress")
+INFLIGHT_FETCHES = Gauge("uf_inflight_fetches", "Upstream checks and downloads in progress", multiprocess_mode="livesum")
+UPSTREAM_ERRORS = Counter("uf_upstream_errors_total", "Upstream failures by kind", ["website", "kind"])
+SQLITE_SECONDS = Histogram("uf_sqlite_seconds", "Time of SQLite statements, including waiting for the lock", ["op"],
+                           buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+EVICTIONS = Counter("uf_evictions_total", "Files evicted from the download buffer")
+BUFFER_BYTES = Gauge("uf_buffer_bytes", "Bytes used by the download buffer", multiprocess_mode="mostrecent")
+# 带 from_version 的下载请求：patch 返回了补丁，full 没有可用的补丁而返回整个文件
+DELTA_REQUESTS = Counter("uf_delta_requests_total", "Download requests with from_version by result", ["result"])
+DELTA_BUILDS = Counter("uf_delta_builds_total", "Patches computed between cached versions by outcome", ["outcome"])
+# 事件循环比预定晚多久才执行到定时的回调，反映有没有回调占着事件循环
+LOOP_LAG = Histogram("uf_loop_lag_seconds", "How late the event loop runs a scheduled callback",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+
+
+def prepare_multiprocess_dir(path: str):
+    """多个进程时各进程把指标写到这个目录下的文件里，/metrics 汇总所有进程的。要在启动各进程前设置，并清掉上次运行留下的文件"""
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+
+
+def generate_metrics() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def mark_process_exited():
+    """进程退出后不再计入 livesum 的 Gauge"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+# 当前请求里各阶段累计的耗时，只在需要记录慢请求时设置
+_stage_times: ContextVar[dict[str, float] | None] = ContextVar("stage_times", default=None)
+
+
+def _add_stage_time(stage: str, elapsed: float):
+    times = _stage_times.get()
+    if times is not None:
+        times[stage] = times.get(stage, 0) + elapsed
+
+
+@contextmanager
+def timed(website: str, stage: str):
+    """记录一个阶段的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(website, stage).observe(elapsed)
+        _add_stage_time(stage, elapsed)
+
+
+@contextmanager
+def timed_sql(sql: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        SQLITE_SECONDS.labels(sql.lstrip().split(None, 1)[0].upper()).observe(elapsed)
+        _add_stage_time("sqlite", elapsed)
+
+
+@contextmanager
+def slow_request_log(logger: logging.Logger, what: str, threshold: float):
+    """threshold 大于 0 时，耗时超过它的请求记下各阶段的耗时。发起上游工作的请求才有那些阶段，合并进来的请求只有总耗时"""
+    if threshold <= 0:
+        yield
+        return
+    times: dict[str, float] = {}
+    token = _stage_times.set(times)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_times.reset(token)
+        elapsed = time.perf_counter() - start
+        if elapsed >= threshold:
+            stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in times.items())
+            logger.warning(f"slow request {what} took {elapsed:.3f}s" + (f": {stages}" if stages else ""))
+
+
+class LoopLagMonitor:
+    """事件循环里定时醒来，记下比预定晚了多久；另有一个线程盯着，事件循环超过 threshold 秒没醒来时，
+    记下它当时正在执行的调用栈，找出卡住它的代码。threshold 为 0 时只记录延迟"""
+    interval = 0.1
+
+    def __init__(self, logger: logging.Logger, threshold: float):
+        self.logger = logger
+        self.threshold = threshold
+        self._task: asyncio.Task | None = None
+        self._stopped = threading.Event()
+        self._loop_thread = 0
+        self._beat = 0.0
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run())
+        if self.threshold > 0:
+            threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(LoopLagMonitor.interval)
+            now = time.monotonic()
+            LOOP_LAG.observe(max(0.0, now - self._beat - LoopLagMonitor.interval))
+            self._beat = now
+
+    def _watch(self):
+        reported = None   # 同一次卡住只记一次
+        while not self._stopped.wait(LoopLagMonitor.interval):
+            beat = self._beat
+            blocked = time.monotonic() - beat - LoopLagMonitor.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            self.logger.warning(f"event loop blocked for more than {blocked:.3f}s, it is running:\n{stack}")
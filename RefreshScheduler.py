@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timezone
+
+from AutoCallerFactory import AllocateDownloader
+from dataHandle import Data, ItemLocation
+from configHandle import config
+from downloader import GithubDownloader, version_cache
+from downloader.VersionCache import VersionCache
+
+
+class RefreshStatus:
+    """单个下载项的后台检查情况"""
+    __slots__ = ("website", "project_name", "stale_seconds", "next_check", "last_check", "last_outcome", "running")
+
+    def __init__(self, website: str, project_name: str, stale_seconds: float, next_check: float):
+        self.website = website
+        self.project_name = project_name
+        self.stale_seconds = stale_seconds
+        self.next_check = next_check
+        self.last_check: float | None = None
+        self.last_outcome = ""
+        self.running = False
+
+    def to_dict(self, item_location: ItemLocation) -> dict:
+        return {
+            "name": item_location.name,
+            "platform": item_location.platform,
+            "arch": item_location.arch,
+            "next_check": datetime.fromtimestamp(self.next_check, timezone.utc).isoformat(timespec="seconds"),
+            "last_check": datetime.fromtimestamp(self.last_check, timezone.utc).isoformat(timespec="seconds") if self.last_check else None,
+            "last_outcome": self.last_outcome,
+            "running": self.running,
+        }
+
+
+class RefreshScheduler:
+    """后台定期检查所有下载项的新版本并预先下载，让用户的请求几乎不用等上游。多个进程时只有持有租约的那个进行"""
+    lease_key = "refresh-scheduler"
+    startup_spread = 600   # 启动时已过期或未缓存的下载项，分散到这段时间（秒）里检查
+    jitter = 0.1   # 每次检查的间隔在过期时长上下浮动的比例
+    max_sleep = 60   # 至少这么久醒来一次，以发现下载项的变化
+    retry_delay = 3600   # 检查失败后，最晚这么久（秒）重试
+
+    def __init__(self, data: Data, allocate_downloader: AllocateDownloader):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.data = data
+        self.allocate_downloader = allocate_downloader
+        self.status: dict[ItemLocation, RefreshStatus] = {}
+        self._task: asyncio.Task | None = None
+        self._checks: set[asyncio.Task] = set()
+        self.leading = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self.logger.info("background refresh started")
+
+    async def stop(self):
+        tasks = [t for t in (self._task, *self._checks) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        if self.leading:
+            await self.data.release_lease(RefreshScheduler.lease_key)
+            self.leading = False
+
+    def report(self) -> list[dict]:
+        return [status.to_dict(loc) for loc, status in sorted(self.status.items(), key=lambda kv: kv[1].next_check)]
+
+    def _plan(self):
+        """为新出现的下载项安排首次检查，更新改动了的，并丢掉已被删除的"""
+        now = time.time()
+        rows = self.data.get_refresh_rows()
+        for item_location, website, project_name, stale_day, cached, last_checked in rows:
+            stale_seconds = stale_day * 86400
+            # checked_at 是不带时区的 UTC 时间
+            checked = last_checked.replace(tzinfo=timezone.utc).timestamp() if cached and last_checked else None
+            status = self.status.get(item_location)
+            if status is None:
+                self.status[item_location] = RefreshStatus(website, project_name, stale_seconds, self._schedule(checked, stale_seconds, now))
+                continue
+            stale_changed = status.stale_seconds != stale_seconds
+            status.website, status.project_name, status.stale_seconds = website, project_name, stale_seconds
+            if status.running:   # 检查完会按新的过期时长安排
+                continue
+            if stale_changed:
+                status.next_check = self._schedule(checked, stale_seconds, now)
+            elif checked is not None and checked + stale_seconds * (1 - self.jitter) > status.next_check:   # 用户的请求或其他进程刚检查过
+                status.next_check = self._schedule(checked, stale_seconds, now)
+        current = {row[0] for row in rows}
+        for item_location in [loc for loc in self.status if loc not in current]:
+            del self.status[item_location]
+
+    def _schedule(self, checked: float | None, stale_seconds: float, now: float) -> float:
+        """上次检查后过了过期时长再检查，已过期或没缓存的分散到 startup_spread 里尽快检查"""
+        due = checked + stale_seconds if checked is not None else now
+        if due <= now:
+            return now + random.uniform(0, self.startup_spread)
+        return due + random.uniform(0, self.jitter * stale_seconds)
+
+    async def _run(self):
+        while True:
+            # 每轮醒来时续期，有效期留出几轮的余量
+            try:
+                self.leading = await self.data.try_lease(RefreshScheduler.lease_key, self.max_sleep * 3)
+            except Exception as e:
+                self.logger.error(f"failed to renew the refresh lease: {e}")
+                self.leading = False
+            if not self.leading:
+                self.status.clear()
+                await asyncio.sleep(self.max_sleep)
+                continue
+            try:
+                self._plan()
+            except Exception as e:
+                self.logger.error(f"failed to plan background refresh: {e}")
+            now = time.time()
+            due = [(loc, s) for loc, s in self.status.items() if not s.running and s.next_check <= now]
+            for _, status in due:
+                status.running = True
+            await self._prefetch_github_versions([status for _, status in due])
+            for item_location, status in due:
+                task = asyncio.create_task(self._check(item_location, status))
+                self._checks.add(task)
+                task.add_done_callback(self._checks.discard)
+            now = time.time()
+            pending = [s.next_check for s in self.status.values() if not s.running]
+            delay = min(pending, default=now + self.max_sleep) - now
+            await asyncio.sleep(min(max(delay, 1), self.max_sleep))
+
+    async def _prefetch_github_versions(self, statuses: list[RefreshStatus]):
+        """配置了 token 时，用一次 GraphQL 查询填充这一批 GitHub 项目的版本缓存，后面的检查就不用逐个调用 API"""
+        if not config.GithubAPI:
+            return
+        stale_seconds = {}
+        for status in statuses:
+            if status.website == "github" and version_cache.peek(("github", status.project_name)) is None:
+                stale_seconds.setdefault(status.project_name, status.stale_seconds)
+        if len(stale_seconds) < 2:
+            return
+        try:
+            tags = await GithubDownloader.get_latest_tags(list(stale_seconds), config.GithubAPI)
+        except Exception as e:
+            self.logger.warning(f"failed to get latest tags by GraphQL: {e}")
+            return
+        for project_name, tag in tags.items():
+            version_cache.put(("github", project_name), tag, VersionCache.ttl_of(stale_seconds[project_name] / 86400))
+        self.logger.info(f"got latest tags of {len(tags)} GitHub projects in one GraphQL query")
+
+    async def _check(self, item_location: ItemLocation, status: RefreshStatus):
+        outcome = ""
+        try:
+            item_info = self.data.get_item_situation(item_location)
+            if not item_info:
+                outcome = "removed"
+            elif not item_info.buf_id and not await self._has_room():
+                outcome = "skipped: buffer full"
+            else:
+                outcome = await self.allocate_downloader.refresh(item_info)
+        except Exception as e:
+            outcome = f"error: {e}"
+            self.logger.error(f"background refresh of {item_location} failed: {e}")
+        finally:
+            now = time.time()
+            status.last_check = now
+            status.last_outcome = outcome
+            interval = status.stale_seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+            if outcome not in ("updated", "up to date", "done by another worker"):
+                interval = min(interval, self.retry_delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+            status.next_check = now + interval
+            status.running = False
+
+    async def _has_room(self) -> bool:
+        """未缓存的下载项只在缓存空间还有余量时预先下载"""
+        return await self.data.get_buf_size_mb() < config.max_buf_space_mb
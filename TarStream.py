@@ -0,0 +1,51 @@
+import os
+import tarfile
+
+import aiofiles
+
+
+class TarStream:
+    """把几个文件依次拼成 tar 流式发出，不在内存或磁盘上生成整个归档。文件在创建时就全部打开，
+    发送期间即使被淘汰或替换，读到的仍是打开时的内容。长度事先算好，可以给出 Content-Length"""
+    __slots__ = ("entries", "length")
+    block_size = tarfile.BLOCKSIZE
+
+    def __init__(self):
+        self.entries: list[tuple[bytes, object, int]] = []   # (头部, 打开的文件, 大小)
+        self.length = 2 * TarStream.block_size   # 结尾的两个空块
+
+    async def add(self, path: str, arcname: str):
+        f = await aiofiles.open(path, 'rb')
+        stat_result = os.fstat(f.fileno())
+        info = tarfile.TarInfo(arcname)
+        info.size = stat_result.st_size
+        info.mtime = int(stat_result.st_mtime)
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8")
+        self.entries.append((header, f, info.size))
+        self.length += len(header) + info.size + TarStream._padding(info.size)
+
+    async def aclose(self):
+        for _, f, _ in self.entries:
+            await f.close()
+        self.entries.clear()
+
+    async def iterate(self, chunk_size: int):
+        try:
+            for header, f, size in self.entries:
+                yield header
+                remaining = size
+                while remaining:
+                    chunk = await f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise OSError(f"{f.name} was truncated while sending")
+                    remaining -= len(chunk)
+                    yield chunk
+                yield b"\0" * TarStream._padding(size)
+            yield b"\0" * (2 * TarStream.block_size)
+        finally:
+            await self.aclose()
+
+    @staticmethod
+    def _padding(size: int) -> int:
+        return -size % TarStream.block_size
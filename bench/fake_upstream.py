@@ -0,0 +1,187 @@
+"""基准测试用的假上游，模仿 GitHub release API 与下载跳转、F-Droid 仓库索引和软件页、只有一个链接的下载。
+可以设定响应延迟、每个连接的带宽和中途断开的概率，并统计收到的请求。
+
+    python -m uvicorn --app-dir bench fake_upstream:app --port 8901
+
+环境变量 FAKE_LATENCY（秒）、FAKE_BANDWIDTH（字节每秒，0 不限）、FAKE_FAIL_RATE（0~1）、FAKE_SIZE（字节）给出初始设定，
+运行中可以用 /_control/settings 修改。/_control/release 发布新版本，/_control/stats 和 /_control/reset 查看和清空统计"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+settings = {
+    "latency": float(os.getenv("FAKE_LATENCY", 0)),
+    "bandwidth": int(os.getenv("FAKE_BANDWIDTH", 0)),
+    "fail_rate": float(os.getenv("FAKE_FAIL_RATE", 0)),
+    "size": int(os.getenv("FAKE_SIZE", 4 * 1024 * 1024)),
+}
+stats: Counter = Counter()
+# 项目 -> 第几次发布，没发布过的为 1
+releases: Counter = Counter()
+chunk_size = 64 * 1024
+
+
+def release_of(project: str) -> int:
+    return releases[project] + 1
+
+
+async def delay():
+    if settings["latency"]:
+        await asyncio.sleep(settings["latency"])
+
+
+def asset_block(path: str) -> bytes:
+    """每个路径的内容都不同，避免被按内容去重"""
+    seed = hashlib.sha256(path.encode()).digest()
+    return (seed * (chunk_size // len(seed) + 1))[:chunk_size]
+
+
+async def asset(request: Request) -> Response:
+    """按路径生成内容的文件，支持 HEAD 和单个 Range"""
+    path = request.url.path
+    size = settings["size"]
+    etag = '"' + hashlib.sha256(f"{path}:{size}".encode()).hexdigest()[:16] + '"'
+    start, end, status = 0, size - 1, 200
+    rng = request.headers.get("range")
+    if rng and request.headers.get("if-range", etag) == etag:
+        first, _, last = rng.removeprefix("bytes=").partition("-")
+        start, end, status = int(first), min(int(last) if last else end, end), 206
+        if start > end:
+            return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+    headers = {"content-length": str(end - start + 1), "accept-ranges": "bytes", "etag": etag}
+    if status == 206:
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+    await delay()
+    if request.method == "HEAD":
+        stats["asset_head"] += 1
+        return Response(status_code=status, headers=headers)
+    stats["asset_get"] += 1
+    fail_at = random.randint(start, end) if random.random() < settings["fail_rate"] else None
+    block = asset_block(path)
+
+    async def body():
+        pos = start
+        while pos <= end:
+            if fail_at is not None and pos >= fail_at:
+                stats["asset_failed"] += 1
+                raise ConnectionAbortedError("injected failure")
+            offset = pos % chunk_size
+            chunk = block[offset:min(chunk_size, offset + end + 1 - pos)]
+            if settings["bandwidth"]:
+                await asyncio.sleep(len(chunk) / settings["bandwidth"])
+            stats["asset_bytes"] += len(chunk)
+            pos += len(chunk)
+            yield chunk
+    return StreamingResponse(body(), status_code=status, headers=headers, media_type="application/octet-stream")
+
+
+async def github_latest(request: Request) -> Response:
+    stats["github_api"] += 1
+    project = f"{request.path_params['owner']}/{request.path_params['repo']}"
+    tag = f"v1.0.{release_of(project)}"
+    etag = f'"{tag}"'
+    await delay()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"etag": etag})
+    return JSONResponse({"tag_name": tag}, headers={"etag": etag})
+
+
+async def github_download(request: Request) -> Response:
+    """release 的下载链接跳转到存放文件的地址"""
+    stats["github_redirect"] += 1
+    await delay()
+    p = request.path_params
+    return RedirectResponse(f"/_assets/github/{p['owner']}/{p['repo']}/{p['tag']}/{p['file']}", status_code=302)
+
+
+def fdroid_packages() -> dict[str, list]:
+    packages = {}
+    for project, count in releases.items():
+        if project.startswith("fdroid:"):
+            packages[project.removeprefix("fdroid:")] = [{"versionCode": 100 + count, "nativecode": ["arm64-v8a", "armeabi-v7a"]}]
+    return packages
+
+
+async def fdroid_index(request: Request) -> Response:
+    """index-v1 里只有登记过的软件，由 /_control/reset?fdroid= 或 /_control/release 登记"""
+    stats["fdroid_index"] += 1
+    await delay()
+    body = json.dumps({"repo": {"name": "fake"}, "packages": fdroid_packages()}).encode()
+    etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"etag": etag})
+    return Response(body, media_type="application/json", headers={"etag": etag})
+
+
+async def fdroid_page(request: Request) -> Response:
+    """与 f-droid.org 软件页结构相同的最小页面，供索引里找不到时抓取"""
+    stats["fdroid_page"] += 1
+    await delay()
+    package = request.path_params["package"]
+    code = 100 + releases[f"fdroid:{package}"]
+    html = f"""<div class="package-versions"><ul><li class="package-version">
+        <div class="package-version-header"><a name="1.0.{code}"></a><a name="{code}"></a></div>
+        <p class="package-version-nativecode"><code class="package-nativecode">arm64-v8a</code></p>
+        </li></ul></div>"""
+    return HTMLResponse(html)
+
+
+async def fdroid_apk(request: Request) -> Response:
+    stats["fdroid_apk"] += 1
+    return await asset(request)
+
+
+async def only1link(request: Request) -> Response:
+    """链接不变，跳转到当前发布的内容"""
+    stats["only1link_redirect"] += 1
+    await delay()
+    name = request.path_params["name"]
+    return RedirectResponse(f"/_assets/only1link/{name}/{release_of('only1link:' + name)}", status_code=302)
+
+
+async def control_release(request: Request) -> Response:
+    """?project=owner/repo 或 fdroid:包名 或 only1link:名称，发布一个新版本"""
+    project = request.query_params["project"]
+    releases[project] += 1
+    return JSONResponse({"project": project, "release": release_of(project)})
+
+
+async def control_settings(request: Request) -> Response:
+    for key, value in request.query_params.items():
+        if key in settings:
+            settings[key] = type(settings[key])(value)
+    return JSONResponse(settings)
+
+
+async def control_stats(request: Request) -> Response:
+    return JSONResponse(dict(stats))
+
+
+async def control_reset(request: Request) -> Response:
+    stats.clear()
+    for project in request.query_params.getlist("fdroid"):   # 让这些软件出现在 F-Droid 索引里
+        releases.setdefault(f"fdroid:{project}", 0)
+    return JSONResponse({})
+
+
+app = Starlette(routes=[
+    Route("/repos/{owner}/{repo}/releases/latest", github_latest),
+    Route("/{owner}/{repo}/releases/download/{tag}/{file}", github_download, methods=["GET", "HEAD"]),
+    Route("/repo/index-v1.json", fdroid_index),
+    Route("/repo/{apk}", fdroid_apk, methods=["GET", "HEAD"]),
+    Route("/packages/{package}/", fdroid_page),
+    Route("/only1link/{name}", only1link, methods=["GET", "HEAD"]),
+    Route("/_assets/{path:path}", asset, methods=["GET", "HEAD"]),
+    Route("/_control/release", control_release, methods=["POST"]),
+    Route("/_control/settings", control_settings, methods=["POST"]),
+    Route("/_control/stats", control_stats),
+    Route("/_control/reset", control_reset, methods=["POST"]),
+])
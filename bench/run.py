@@ -0,0 +1,306 @@
+"""离线运行的基准测试：启动假上游（fake_upstream.py）和 UpdateFetch，用并发的客户端跑几个场景，
+输出 JSON，方便在不同提交之间对比。每个场景都用全新的数据目录和新的 UpdateFetch 进程。
+
+    python bench/run.py                                   # 跑全部场景，结果打印到标准输出
+    python bench/run.py -s hot_hit herd -o result.json --clients 32 --latency 0.05
+
+场景：
+    cold_miss   全新缓存，每个下载项请求一次，全部要从上游下载
+    hot_hit     已缓存，大量并发请求命中缓存
+    herd        发布新版本后，大量客户端同时请求同一个下载项
+    eviction    缓存空间只够放几个文件，轮流请求更多的下载项
+    index       并发请求首页，一半带 If-None-Match
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from ruamel.yaml import YAML
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+yaml = YAML()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Server:
+    """在子进程里用 uvicorn 运行的一个 ASGI 应用"""
+
+    def __init__(self, app: str, app_dir: str, env: dict[str, str], log_path: str):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log = open(log_path, "wb")
+        cmd = [sys.executable, "-m", "uvicorn", app, "--app-dir", app_dir, "--port", str(self.port),
+               "--log-level", "warning", "--no-access-log"]
+        self.proc = subprocess.Popen(cmd, cwd=ROOT, env={**os.environ, **env}, stdout=self.log, stderr=subprocess.STDOUT)
+
+    async def wait_ready(self, path: str, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self.proc.poll() is not None:
+                    raise RuntimeError(f"server exited with {self.proc.returncode}, see {self.log.name}")
+                try:
+                    if (await client.get(self.url + path)).status_code == 200:
+                        return
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+        raise TimeoutError(f"server not ready in {timeout}s, see {self.log.name}")
+
+    def peak_rss_mb(self) -> float | None:
+        """进程的内存峰值，只支持 Linux"""
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+
+
+def make_items(count: int, stale_days: int) -> tuple[dict, list[str]]:
+    """每种网站各 count 个下载项，返回下载项配置和它们的下载链接"""
+    items, links = {}, []
+    for i in range(count):
+        items[f"bench_gh{i}"] = {
+            "category": "Bench", "website": "github", "project_name": f"bench/proj{i}", "staleDurationDay": stale_days,
+            "sample_url": "~/{{ tag }}/proj-{{ system }}-{{ arch }}{{ suffix_name }}",
+            "system": {"linux": ["linux", ".tar.gz"]}, "architecture": {"amd64": "amd64"},
+        }
+        items[f"bench_fd{i}"] = {
+            "category": "Bench", "website": "fdroid", "project_name": f"org.bench.app{i}", "staleDurationDay": stale_days,
+            "architecture": {"arm64": "arm64-v8a"},
+        }
+        items[f"bench_ol{i}"] = {
+            "category": "Bench", "website": "only1link", "project_name": "http://only1link.bench/",
+            "sample_url": f"http://only1link.bench/only1link/file{i}", "staleDurationDay": stale_days,
+            "system": {"linux": ["linux", ".bin"]}, "architecture": {"amd64": "amd64"},
+        }
+        links += [download_link(f"bench_gh{i}"), download_link(f"bench_fd{i}", "android", "arm64"), download_link(f"bench_ol{i}")]
+    return items, links
+
+
+def download_link(name: str, platform: str = "linux", arch: str = "amd64") -> str:
+    return f"/download/?name={name}&platform={platform}&arch={arch}"
+
+
+def write_configs(workdir: str, fake_url: str, items: dict, max_buf_space_mb: float) -> dict[str, str]:
+    """写入这个场景的配置文件，返回启动 UpdateFetch 需要的环境变量"""
+    data_dir = os.path.join(workdir, "data")
+    download_dir = os.path.join(workdir, "download")
+    os.makedirs(data_dir)
+    os.makedirs(download_dir)
+    user_config = {
+        "user_configuration": True,
+        "max_buf_space_mb": max_buf_space_mb,
+        "concurrent_amount_per_website": 4,
+    }
+    pgm_config = {
+        "program_configuration": True,
+        "items_file": os.path.join(workdir, "items.yaml"),
+        "temp_download_dir": download_dir,
+        "data_dir": data_dir,
+        "upstream_override": {host: fake_url for host in ("api.github.com", "github.com", "f-droid.org", "only1link.bench")},
+        "logging": {
+            "version": 1,
+            "disable_existing_loggers": False,
+            "handlers": {"console": {"class": "logging.StreamHandler", "level": "WARNING", "stream": "ext://sys.stdout"}},
+            "root": {"level": "WARNING", "handlers": ["console"]},
+        },
+    }
+    files = {"config.yaml": user_config, "pgm_config.yaml": pgm_config, "items.yaml": items}
+    for filename, content in files.items():
+        with open(os.path.join(workdir, filename), "w", encoding="utf-8") as f:
+            yaml.dump(content, f)
+    return {
+        "UPDATEFETCH_CONFIG_FILE": os.path.join(workdir, "config.yaml"),
+        "UPDATEFETCH_PGM_CONFIG_FILE": os.path.join(workdir, "pgm_config.yaml"),
+    }
+
+
+async def drive(client: httpx.AsyncClient, paths: list[str], clients: int, headers: list[dict] | None = None) -> dict:
+    """clients 个并发的客户端依次请求 paths，读完并丢弃响应内容，返回吞吐量和延迟"""
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    received = 0
+    queue = list(enumerate(paths))
+    queue.reverse()
+
+    async def worker():
+        nonlocal received
+        while queue:
+            i, path = queue.pop()
+            start = time.perf_counter()
+            try:
+                async with client.stream("GET", path, headers=headers[i] if headers else None) as resp:
+                    async for chunk in resp.aiter_raw():
+                        received += len(chunk)
+                status = str(resp.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    duration = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2) if latencies else 0
+
+    return {
+        "requests": len(paths),
+        "clients": clients,
+        "statuses": statuses,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(paths) / duration, 1) if duration else 0,
+        "received_mb": round(received / 1024 / 1024, 1),
+        "mb_per_s": round(received / 1024 / 1024 / duration, 1) if duration else 0,
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0,
+    }
+
+
+async def cold_miss(client, fake, links, args) -> dict:
+    return await drive(client, links, args.clients)
+
+
+async def hot_hit(client, fake, links, args) -> dict:
+    await drive(client, links, args.clients)
+    await fake.post("/_control/reset")
+    return await drive(client, [random.choice(links) for _ in range(args.requests)], args.clients)
+
+
+async def herd(client, fake, links, args) -> dict:
+    link = download_link("bench_gh0")
+    await drive(client, [link], 1)
+    await fake.post("/_control/release", params={"project": "bench/proj0"})
+    await fake.post("/_control/reset")
+    return await drive(client, [link] * args.clients, args.clients)
+
+
+async def eviction(client, fake, links, args) -> dict:
+    github_links = [download_link(f"bench_gh{i}") for i in range(args.items)]
+    return await drive(client, [github_links[i % len(github_links)] for i in range(args.requests // 10)], args.clients)
+
+
+async def index(client, fake, links, args) -> dict:
+    etag = (await client.get("/")).headers.get("etag", "")
+    headers = [{"If-None-Match": etag} if i % 2 else {} for i in range(args.requests)]
+    return await drive(client, ["/"] * args.requests, args.clients, headers)
+
+
+SCENARIOS = {
+    "cold_miss": cold_miss,
+    "hot_hit": hot_hit,
+    "herd": herd,
+    "eviction": eviction,
+    "index": index,
+}
+
+
+def parse_metric(text: str, name: str) -> float | None:
+    for line in text.splitlines():
+        if line.startswith(name + " ") or line.startswith(name + "{"):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+async def run_scenario(name: str, fake_url: str, args) -> dict:
+    size_mb = args.size_mb
+    # herd 要每次都检查新版本；eviction 的缓存只够放三个文件
+    stale_days = 0 if name == "herd" else 30
+    max_buf_space_mb = size_mb * 3 if name == "eviction" else size_mb * args.items * 10
+    items, links = make_items(args.items, stale_days)
+    async with httpx.AsyncClient(base_url=fake_url) as fake:
+        await fake.post("/_control/reset", params={"fdroid": [f"org.bench.app{i}" for i in range(args.items)]})
+        with tempfile.TemporaryDirectory(prefix=f"uf-bench-{name}-") as workdir:
+            env = write_configs(workdir, fake_url, items, max_buf_space_mb)
+            app = Server("main:app", ROOT, env, os.path.join(workdir, "app.log"))
+            try:
+                await app.wait_ready("/api/refresh-status")
+                async with httpx.AsyncClient(base_url=app.url, timeout=300) as client:
+                    result = await SCENARIOS[name](client, fake, links, args)
+                    metrics = (await client.get("/metrics")).text
+                result["peak_rss_mb"] = app.peak_rss_mb()
+                result["evictions"] = parse_metric(metrics, "uf_evictions_total")
+                result["upstream"] = (await fake.get("/_control/stats")).json()
+            finally:
+                app.stop()
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def main(args):
+    env = {
+        "FAKE_LATENCY": str(args.latency),
+        "FAKE_BANDWIDTH": str(int(args.bandwidth_mb * 1024 * 1024)),
+        "FAKE_FAIL_RATE": str(args.fail_rate),
+        "FAKE_SIZE": str(int(args.size_mb * 1024 * 1024)),
+    }
+    log_dir = tempfile.mkdtemp(prefix="uf-bench-")
+    fake = Server("fake_upstream:app", os.path.join(ROOT, "bench"), env, os.path.join(log_dir, "fake_upstream.log"))
+    try:
+        await fake.wait_ready("/_control/stats")
+        results = {}
+        for name in args.scenarios:
+            print(f"running {name}", file=sys.stderr)
+            results[name] = await run_scenario(name, fake.url, args)
+    finally:
+        fake.stop()
+    report = {
+        "revision": git_revision(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("scenarios", "output")},
+        "scenarios": results,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UpdateFetch benchmarks against a local fake upstream")
+    parser.add_argument("-s", "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="requests in hot_hit and index; eviction uses a tenth")
+    parser.add_argument("--items", type=int, default=4, help="items per website")
+    parser.add_argument("--size-mb", type=float, default=4, help="size of each upstream file")
+    parser.add_argument("--latency", type=float, default=0, help="upstream delay before each response, seconds")
+    parser.add_argument("--bandwidth-mb", type=float, default=0, help="upstream bandwidth per connection, MB/s, 0 for unlimited")
+    parser.add_argument("--fail-rate", type=float, default=0, help="probability that an upstream file transfer is cut midway")
+    random.seed(0)
+    asyncio.run(main(parser.parse_args()))
@@ -47,10 +47,23 @@ class Config(object):
         self.temp_download_dir = os.path.abspath(program_configs["temp_download_dir"]) 
         self.data_dir = program_configs["data_dir"]
         self.sqlite_db_path = os.path.join(self.data_dir, "uf.db")
+        self.upstream_override = program_configs.get("upstream_override", {})
         # 用户配置
         self.is_production = user_configs.get("is_production", True)
         self.max_buf_space_mb = user_configs.get("max_buf_space_mb", 1024)
         self.concurrent_amount = user_configs.get("concurrent_amount_per_website", 1)
+        self.stream_through = user_configs.get("stream_through", False)
+        self.background_refresh = user_configs.get("background_refresh", False)
+        self.fdroid_index_url = user_configs.get("fdroid_index_url", "https://f-droid.org/repo/index-v1.json")
+        self.segment_min_size_mb = user_configs.get("segment_min_size_mb", 64)
+        self.max_segments = user_configs.get("max_segments_per_website", {})
+        self.slow_request_seconds = user_configs.get("slow_request_seconds", 0)
+        self.workers = user_configs.get("workers", 1)
+        self.catalog_sync_seconds = user_configs.get("catalog_sync_seconds", 1)
+        self.loop_lag_warning_seconds = user_configs.get("loop_lag_warning_seconds", 0.5)
+        self.delta_updates = user_configs.get("delta_updates", False)
+        self.delta_level = user_configs.get("delta_level", 19)
+        self.delta_max_ratio = user_configs.get("delta_max_ratio", 0.5)
         self.GithubAPI = user_configs.get('GitHub_Api_Token', {})
         self.default_category = user_configs.get('default_category', 'Uncategorized')
         self.default_image = user_configs.get('default_image', "https://ib.ahfei.blog/imagesbed/picture_has_been_chewed_up_by_cat_vfly2.webp")
@@ -1,17 +1,24 @@
+import asyncio
+import contextvars
 import logging
 import os
+import socket
 import sys
 import json
 import textwrap
-from datetime import datetime
+import time
+from datetime import datetime, timezone
 from collections import namedtuple
-from itertools import groupby
 from typing import TypedDict
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import ruamel.yaml
 
 from configHandle import Config
+from Metrics import EVICTIONS, timed_sql
 
 
 class Download(TypedDict):
@@ -37,9 +44,69 @@ ItemLocation = namedtuple(
 # 在程序全流程中传递的一条下载项内容
 ItemInfo = namedtuple(
     "ItemInfo",
-    ["name", "image", "category", "website", "project_name", "homepage", "sample_url", "platform", "arch", "original_platform", "original_arch", "suffix_name", "formated_dl_url", "staleDurationDay", "version", "last_modified", "buf_id"]
+    ["name", "image", "category", "website", "project_name", "homepage", "sample_url", "platform", "arch", "original_platform", "original_arch", "suffix_name", "formated_dl_url", "staleDurationDay", "version", "last_modified", "buf_id", "blob_hash"]
 )
 
+# 下载得到的一份内容：按内容寻址的路径、给客户端的文件名、sha256、字节数、下载直链，以及上游给的 ETag 和 Last-Modified
+Artifact = namedtuple(
+    "Artifact",
+    ["path", "filename", "digest", "size", "url", "etag", "last_modified"],
+    defaults=("", "")
+)
+
+# 数据库中时间的格式，与 CURRENT_TIMESTAMP 一致，为 UTC
+db_time_format = "%Y-%m-%d %H:%M:%S"
+
+def db_now() -> str:
+    return datetime.now(timezone.utc).strftime(db_time_format)
+
+def get_blob_path(download_dir: str, digest: str) -> str:
+    """相同内容只存一份，路径由哈希决定"""
+    return os.path.join(download_dir, "blobs", digest[:2], digest)
+
+def get_delta_path(download_dir: str, from_hash: str, to_hash: str) -> str:
+    """从一个内容到另一个内容的补丁"""
+    return os.path.join(download_dir, "deltas", to_hash[:2], f"{from_hash}-{to_hash}.zst")
+
+class CatalogRecord:
+    """内存目录中的一个下载项：items_table 的一行，以及它在 dl_buf_table 中的缓存情况（未缓存时 buf_id 为 None）"""
+    __slots__ = ("name", "image", "category", "website", "project_name", "homepage", "sample_url", "platform", "arch",
+                 "original_platform", "original_arch", "suffix_name", "formated_dl_url", "stale_duration", "pinned",
+                 "buf_id", "version", "last_modified", "checked_at", "abs_path", "filename", "blob_hash", "size",
+                 "accessed_at", "pending_hits")
+
+    def __init__(self, item_row, buf_row):
+        self.set_item(item_row)
+        self.set_buf(*buf_row)
+        self.accessed_at: float | None = None   # 还没写回数据库的访问
+        self.pending_hits = 0
+
+    def set_item(self, item_row):
+        """item_row 的顺序同 DBHandle.items_table_columns"""
+        (self.name, self.image, self.category, self.website, self.project_name, self.homepage, self.sample_url, self.platform, self.arch,
+         self.original_platform, self.original_arch, self.suffix_name, self.formated_dl_url, self.stale_duration, self.pinned) = item_row
+
+    def set_buf(self, buf_id: int | None, version: str | None = None, last_modified: str | None = None, last_checked: str | None = None,
+                abs_path: str | None = None, filename: str | None = None, blob_hash: str | None = None, size: int | None = None):
+        self.buf_id = buf_id
+        self.version = version
+        self.last_modified = last_modified
+        self.checked_at = datetime.strptime(last_checked, db_time_format) if last_checked else None
+        self.abs_path = abs_path
+        self.filename = filename
+        self.blob_hash = blob_hash
+        self.size = size
+
+    @property
+    def location(self) -> ItemLocation:
+        return ItemLocation(self.name, self.platform, self.arch)
+
+    def to_item_info(self) -> ItemInfo:
+        return ItemInfo(self.name, self.image, self.category, self.website, self.project_name, self.homepage, self.sample_url,
+                        self.platform, self.arch, self.original_platform, self.original_arch, self.suffix_name, self.formated_dl_url,
+                        self.stale_duration, self.version, self.checked_at, self.buf_id, self.blob_hash)
+
+
 class InvalidProfile(Exception):
     pass
 
@@ -56,11 +123,93 @@ class DBHandle():
             platform TEXT,
             arch TEXT,
             last_modified DATETIME DEFAULT CURRENT_TIMESTAMP,
-            abs_path TEXT)"""
+            abs_path TEXT,
+            last_checked DATETIME DEFAULT CURRENT_TIMESTAMP,
+            size INTEGER,
+            last_access DATETIME DEFAULT CURRENT_TIMESTAMP,
+            hits INTEGER DEFAULT 0,
+            filename TEXT,
+            blob_hash TEXT)"""
+    )
+    # 旧数据库里的 dl_buf_table 缺少的列，启动时补上
+    dl_buf_table_added_columns = (
+        ("last_checked", "DATETIME"),
+        ("size", "INTEGER"),
+        ("last_access", "DATETIME"),
+        ("hits", "INTEGER DEFAULT 0"),
+        ("filename", "TEXT"),
+        ("blob_hash", "TEXT"),
+    )
+
+    # 按内容寻址存储的文件，refcount 是引用它的 dl_buf_table 行数
+    create_blob_table_if_not = textwrap.dedent("""\
+        CREATE TABLE IF NOT EXISTS blob_table (
+            hash TEXT PRIMARY KEY,
+            abs_path TEXT,
+            size INTEGER,
+            refcount INTEGER DEFAULT 0)"""
+    )
+
+    # 下载直链对应的内容，内容不变的直链再次遇到时不必下载；内容会变的直链用上游的校验值做条件请求
+    create_url_blob_table_if_not = textwrap.dedent("""\
+        CREATE TABLE IF NOT EXISTS url_blob_table (
+            url TEXT PRIMARY KEY,
+            hash TEXT,
+            etag TEXT,
+            last_modified TEXT)"""
+    )
+    url_blob_table_added_columns = (
+        ("etag", "TEXT"),
+        ("last_modified", "TEXT"),
+    )
+
+    # 跨进程的租约：同一个键同时只有一个进程持有，过期后可被别的进程取得
+    create_lease_table_if_not = textwrap.dedent("""\
+        CREATE TABLE IF NOT EXISTS lease_table (
+            key TEXT PRIMARY KEY,
+            owner TEXT,
+            expires REAL)"""
+    )
+
+    # 每个下载项从上一版本到当前版本的补丁，一个位置最多一行。patch_path 为 NULL 时还没算出，这一行占着旧内容的一个引用，
+    # 算完后释放；为空字符串时补丁不划算或无法计算
+    create_delta_table_if_not = textwrap.dedent("""\
+        CREATE TABLE IF NOT EXISTS delta_table (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            platform TEXT,
+            arch TEXT,
+            from_version TEXT,
+            from_hash TEXT,
+            to_hash TEXT,
+            patch_path TEXT,
+            size INTEGER DEFAULT 0,
+            patch_hash TEXT,
+            UNIQUE (name, platform, arch))"""
+    )
+
+    select_pending_deltas = textwrap.dedent("""\
+        SELECT
+            delta_table.id, from_blob.abs_path, from_blob.size, to_blob.abs_path, to_blob.size, from_hash, to_hash
+        FROM
+            delta_table
+        INNER JOIN blob_table AS from_blob ON from_blob.hash = delta_table.from_hash
+        INNER JOIN blob_table AS to_blob ON to_blob.hash = delta_table.to_hash
+        WHERE
+            patch_path IS NULL"""
+    )
+
+    # dl_buf_table 的每次改动记一行，其他进程据此更新各自的内存目录
+    create_change_log_if_not = textwrap.dedent("""\
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            platform TEXT,
+            arch TEXT)"""
     )
 
     create_items_table_if_not = textwrap.dedent("""\
-        CREATE TABLE items_table (
+        CREATE TABLE IF NOT EXISTS items_table (
             id INTEGER PRIMARY KEY,
             name TEXT,
             image TEXT,
@@ -75,191 +224,780 @@ class DBHandle():
             original_arch TEXT,
             suffix_name TEXT,
             formated_dl_url TEXT,
-            stale_duration INTEGER)"""
+            stale_duration INTEGER,
+            pinned INTEGER DEFAULT 0)"""
     )
 
-    get_web_elements = textwrap.dedent("""\
+    # 依次对应 ItemInfo 的前面的字段
+    items_table_info_columns = ("name", "image", "category", "website", "project_name", "homepage", "sample_url", "platform", "arch",
+                                "original_platform", "original_arch", "suffix_name", "formated_dl_url", "stale_duration")
+    items_table_columns = items_table_info_columns + ("pinned", )
+    items_table_added_columns = (
+        ("pinned", "INTEGER DEFAULT 0"),
+    )
+
+    # 启动和重载下载项时载入内存目录，之后的查询都不经过数据库
+    select_catalog = textwrap.dedent("""\
         SELECT
-            items_table.name, category, homepage, image, items_table.platform, items_table.arch, formated_dl_url, version, last_modified
+            items_table.name, image, category, website, project_name, homepage, sample_url, items_table.platform, items_table.arch,
+            original_platform, original_arch, suffix_name, formated_dl_url, stale_duration, pinned,
+            dl_buf_table.id, version, last_modified, COALESCE(last_checked, last_modified), abs_path, filename, blob_hash, size
         FROM
             items_table
         LEFT JOIN dl_buf_table
-            ON dl_buf_table.name = items_table.name AND dl_buf_table.platform = items_table.platform AND dl_buf_table.arch = items_table.arch"""
+            ON dl_buf_table.name = items_table.name AND dl_buf_table.platform = items_table.platform AND dl_buf_table.arch = items_table.arch
+        ORDER BY
+            items_table.id"""
     )
 
-    get_item_situation = textwrap.dedent("""\
+    # 没被持有或已过期时取得，自己持有时延期
+    upsert_lease = textwrap.dedent("""\
+        INSERT INTO lease_table (key, owner, expires) VALUES (?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+        WHERE lease_table.expires < ? OR lease_table.owner = excluded.owner"""
+    )
+
+    # 最久没被访问的先淘汰，已不在下载项配置里的更优先；固定的下载项不淘汰
+    select_lru_item = textwrap.dedent("""\
         SELECT
-            dl_buf_table.id, items_table.name, website, project_name, sample_url, items_table.platform, items_table.arch, original_platform, original_arch, suffix_name, version, last_modified, stale_duration, homepage
+            dl_buf_table.id, abs_path, COALESCE(size, 0), blob_hash
         FROM
-            items_table
-        INNER JOIN dl_buf_table
+            dl_buf_table
+        LEFT JOIN items_table
             ON dl_buf_table.name = items_table.name AND dl_buf_table.platform = items_table.platform AND dl_buf_table.arch = items_table.arch
         WHERE
-            items_table.name=? AND items_table.platform=? AND items_table.arch=?"""
+            COALESCE(items_table.pinned, 0) = 0 AND dl_buf_table.id != ?
+        ORDER BY
+            items_table.id IS NULL DESC, COALESCE(last_access, last_modified) ASC
+        LIMIT 1"""
+    )
+
+    create_indexes = (
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_items_location ON items_table (name, platform, arch)",
+        "CREATE INDEX IF NOT EXISTS idx_dl_buf_location ON dl_buf_table (name, platform, arch)",
+        "CREATE INDEX IF NOT EXISTS idx_dl_buf_last_modified ON dl_buf_table (last_modified)",
+        "CREATE INDEX IF NOT EXISTS idx_url_blob_hash ON url_blob_table (hash)",
+    )
+
+    # WAL 让读不被写阻塞；其余为常见的调优参数
+    pragmas = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+        "PRAGMA mmap_size=67108864",
+        "PRAGMA busy_timeout=5000",
     )
 
     def __init__(self, config: Config) -> None:
         self.config = config
+        # 整个进程共用一个长连接，语句由 sqlite3 模块缓存
+        self.conn = sqlite3.connect(config.sqlite_db_path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False, cached_statements=256)
+        self.lock = threading.RLock()
+        for pragma in DBHandle.pragmas:
+            self.conn.execute(pragma)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def add_missing_columns(self, table_name: str, columns):
+        with self.transaction():   # 多个进程同时启动时，只有一个会补上
+            self._add_missing_columns(table_name, columns)
+
+    def _add_missing_columns(self, table_name: str, columns):
+        existing = {row[1] for row in self.get_execute_result(True, f"PRAGMA table_info({table_name})")}
+        for column, declaration in columns:
+            if column not in existing:
+                self.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {declaration}")
+
+    def execute(self, sql: str, arg_tuple=()) -> int | None:
+        """返回插入行的 id"""
+        with self.lock, timed_sql(sql):
+            return self.conn.execute(sql, arg_tuple).lastrowid
+
+    def execute_count(self, sql: str, arg_tuple=()) -> int:
+        """返回改动的行数"""
+        with self.lock, timed_sql(sql):
+            return self.conn.execute(sql, arg_tuple).rowcount
 
-    def execute(self, sql: str, arg_tuple=()):
-        with sqlite3.connect(self.config.sqlite_db_path, isolation_level=None) as conn:
-            conn.execute(sql, arg_tuple)
+    def executemany(self, sql: str, arg_tuples):
+        with self.lock, timed_sql(sql):
+            self.conn.executemany(sql, arg_tuples)
+
+    @contextmanager
+    def transaction(self):
+        """其中的语句要么都生效，要么都不生效"""
+        with self.lock:
+            with timed_sql("BEGIN"):
+                self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            with timed_sql("COMMIT"):
+                self.conn.execute("COMMIT")
+
+    def executescript(self, sqls):
+        with self.lock:
+            for sql in sqls:
+                with timed_sql(sql):
+                    self.conn.execute(sql)
 
     def get_execute_result(self, all_of_them: bool, sql: str, arg_tuple=()):
-        with sqlite3.connect(self.config.sqlite_db_path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES) as conn:
-            cursor = conn.cursor()
-            cursor.execute(sql, arg_tuple)
+        with self.lock, timed_sql(sql):
+            cursor = self.conn.execute(sql, arg_tuple)
             return cursor.fetchall() if all_of_them else cursor.fetchone()
 
-    def insert_item_to_buf(self, name: str, platform: str, arch: str, version: str, path: str):
-        with sqlite3.connect(self.config.sqlite_db_path, isolation_level=None) as conn:
-            conn.execute(
-                "INSERT INTO dl_buf_table (name, platform, arch, version, abs_path) VALUES (?, ?, ?, ?, ?)",
-                (name, platform, arch, version, path)
-            )
+    def insert_item_to_buf(self, name: str, platform: str, arch: str, version: str, path: str, size: int = 0,
+                           filename: str | None = None, blob_hash: str | None = None, now: str | None = None) -> int:
+        """返回新行的 id"""
+        now = now or db_now()
+        return self.execute(
+            "INSERT INTO dl_buf_table (name, platform, arch, version, abs_path, size, filename, blob_hash, last_modified, last_checked, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, platform, arch, version, path, size, filename, blob_hash, now, now, now)
+        ) # type: ignore
+
+    def update_item_in_buf(self, id: int, version: str, path: str, size: int = 0,
+                           filename: str | None = None, blob_hash: str | None = None, now: str | None = None):
+        now = now or db_now()
+        self.execute("UPDATE dl_buf_table SET version = ?, abs_path = ?, size = ?, filename = ?, blob_hash = ?, last_modified = ?, "
+                     "last_checked = ?, last_access = ? WHERE id = ?", (version, path, size, filename, blob_hash, now, now, now, id))
+
+    def acquire_blob(self, artifact: Artifact):
+        """登记内容并增加引用计数，同时记下直链对应的内容"""
+        self.execute("INSERT OR IGNORE INTO blob_table (hash, abs_path, size, refcount) VALUES (?, ?, ?, 0)",
+                     (artifact.digest, artifact.path, artifact.size))
+        self.execute("UPDATE blob_table SET refcount = refcount + 1 WHERE hash = ?", (artifact.digest, ))
+        if artifact.url:
+            self.execute("INSERT OR REPLACE INTO url_blob_table (url, hash, etag, last_modified) VALUES (?, ?, ?, ?)",
+                         (artifact.url, artifact.digest, artifact.etag, artifact.last_modified))
+
+    def release_blob(self, digest: str) -> str:
+        """减少引用计数，没有引用了则删除记录，返回应删除的文件路径，否则返回空字符串"""
+        self.execute("UPDATE blob_table SET refcount = refcount - 1 WHERE hash = ?", (digest, ))
+        res = self.get_execute_result(False, "SELECT abs_path, refcount FROM blob_table WHERE hash = ?", (digest, ))
+        if not res or res[1] > 0:
+            return ""
+        self.execute("DELETE FROM blob_table WHERE hash = ?", (digest, ))
+        self.execute("DELETE FROM url_blob_table WHERE hash = ?", (digest, ))
+        return res[0]
+
+    def get_blob_by_url(self, url: str):
+        query = "SELECT blob_table.hash, abs_path, size, etag, last_modified FROM url_blob_table INNER JOIN blob_table ON blob_table.hash = url_blob_table.hash WHERE url = ?"
+        return self.get_execute_result(False, query, (url, ))
+
+    def save_accesses(self, rows):
+        """rows 为 (last_access, 新增的访问次数, id)。多个进程各自写回，只保留较晚的访问时间"""
+        self.executemany("UPDATE dl_buf_table SET last_access = MAX(COALESCE(last_access, ''), ?), hits = COALESCE(hits, 0) + ? WHERE id = ?", rows)
 
-    def update_item_in_buf(self, id: int, version: str, path: str):
-        with sqlite3.connect(self.config.sqlite_db_path, isolation_level=None) as conn:
-            conn.execute("UPDATE dl_buf_table SET version = ?, abs_path = ? WHERE id = ?", (version, path, id))
+    def get_buf_size(self) -> int:
+        """共享的内容只算一次；旧版本留下的、不按内容寻址的文件单独计算"""
+        return self.get_execute_result(False, "SELECT (SELECT COALESCE(SUM(size), 0) FROM blob_table) + "
+                                       "(SELECT COALESCE(SUM(size), 0) FROM dl_buf_table WHERE blob_hash IS NULL) + "
+                                       "(SELECT COALESCE(SUM(size), 0) FROM delta_table)")[0]
+
+    def touch_checked(self, id: int, now: str):
+        """检查过没有新版本，重新开始计算过期时间"""
+        self.execute("UPDATE dl_buf_table SET last_checked = ? WHERE id = ?", (now, id))
 
     def get_item_from(self, table_name: str, item_location: ItemLocation):
+        # 在 SQLite 中，表名和列名不能使用参数化查询的占位符（如 ?）
         query = f"SELECT * FROM {table_name} WHERE name=? AND platform=? AND arch=?"
-        with sqlite3.connect(self.config.sqlite_db_path, isolation_level=None) as conn:
-            cursor = conn.cursor()
-            # 在 SQLite 中，表名和列名不能使用参数化查询的占位符（如 ?）
-            cursor.execute(query, item_location)
-            return cursor.fetchone()
+        return self.get_execute_result(False, query, tuple(item_location))
+
+    def del_item_in_buf_by_id(self, id: int, abs_path: str) -> bool:
+        """只在这一行仍是该文件时删除，返回是否删除了。其他进程可能已经删除或更新了它"""
+        return self.execute_count("DELETE FROM dl_buf_table WHERE id=? AND abs_path=?", (id, abs_path)) > 0
+
+    def get_buf_row(self, item_location: ItemLocation):
+        """返回 (id, version, last_modified, last_checked, abs_path, filename, blob_hash, size)，顺序同 CatalogRecord.set_buf"""
+        return self.get_execute_result(False, "SELECT id, version, last_modified, COALESCE(last_checked, last_modified), abs_path, filename, blob_hash, size "
+                                       "FROM dl_buf_table WHERE name=? AND platform=? AND arch=? ORDER BY id LIMIT 1", tuple(item_location))
+
+    def has_blob(self, digest: str) -> bool:
+        return self.get_execute_result(False, "SELECT 1 FROM blob_table WHERE hash = ?", (digest, )) is not None
 
-    def del_item_in_buf_by_id(self, id: int):
-        with sqlite3.connect(self.config.sqlite_db_path, isolation_level=None) as conn:
-            conn.execute("DELETE FROM dl_buf_table WHERE id=?", (id, ))
+    def get_blob_hashes(self) -> set[str]:
+        return {row[0] for row in self.get_execute_result(True, "SELECT hash FROM blob_table")}
 
-    def get_oldest_item(self):
-        query = f"SELECT id, abs_path FROM dl_buf_table ORDER BY last_modified ASC LIMIT 1"
-        with sqlite3.connect(self.config.sqlite_db_path, isolation_level=None) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            return cursor.fetchone()
+    def get_delta_filenames(self) -> set[str]:
+        return {os.path.basename(row[0]) for row in self.get_execute_result(True, "SELECT patch_path FROM delta_table WHERE patch_path != ''")}
+
+    def get_delta(self, item_location: ItemLocation):
+        """返回 (id, from_version, from_hash, to_hash, patch_path, patch_hash)"""
+        query = "SELECT id, from_version, from_hash, to_hash, patch_path, patch_hash FROM delta_table WHERE name=? AND platform=? AND arch=?"
+        return self.get_execute_result(False, query, tuple(item_location))
+
+    def insert_delta(self, item_location: ItemLocation, from_version: str, from_hash: str, to_hash: str):
+        self.execute("INSERT INTO delta_table (name, platform, arch, from_version, from_hash, to_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                     (*item_location, from_version, from_hash, to_hash))
+
+    def try_lease(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        return self.execute_count(DBHandle.upsert_lease, (key, owner, now + ttl, now)) > 0
+
+    def release_lease(self, key: str | None, owner: str):
+        """key 为 None 时释放 owner 的所有租约"""
+        if key is None:
+            self.execute("DELETE FROM lease_table WHERE owner = ?", (owner, ))
+        else:
+            self.execute("DELETE FROM lease_table WHERE key = ? AND owner = ?", (key, owner))
+
+    def get_items_rows(self):
+        return self.get_execute_result(True, f"SELECT {', '.join(DBHandle.items_table_columns)} FROM items_table ORDER BY id")
+
+    def apply_items(self, rows) -> int:
+        """把 items_table 改成 rows，只写入增删改的行，返回改动的行数。应在事务中调用"""
+        def location(row):
+            return ItemLocation(row[0], row[7], row[8])
+        existing = {location(row): row for row in self.get_items_rows()}
+        desired = {location(row): tuple(row) for row in rows}
+        removed = [tuple(loc) for loc in existing if loc not in desired]
+        added = [row for loc, row in desired.items() if loc not in existing]
+        changed = [row[1:7] + row[9:] + tuple(loc) for loc, row in desired.items() if loc in existing and existing[loc] != row]
+        if removed:
+            self.executemany("DELETE FROM items_table WHERE name=? AND platform=? AND arch=?", removed)
+        if added:
+            self.executemany(f"INSERT INTO items_table ({', '.join(DBHandle.items_table_columns)}) "
+                             f"VALUES ({', '.join('?' * len(DBHandle.items_table_columns))})", added)
+        if changed:
+            columns = DBHandle.items_table_columns[1:7] + DBHandle.items_table_columns[9:]
+            self.executemany(f"UPDATE items_table SET {', '.join(c + ' = ?' for c in columns)} WHERE name=? AND platform=? AND arch=?", changed)
+        return len(removed) + len(added) + len(changed)
+
+    def log_change(self, item_location: ItemLocation):
+        """name 等为 None 的一行表示下载项有变动"""
+        self.execute("INSERT INTO change_log (name, platform, arch) VALUES (?, ?, ?)", tuple(item_location))
+
+    def get_changes(self, after_seq: int):
+        """返回 seq 之后的改动 (seq, name, platform, arch)"""
+        return self.get_execute_result(True, "SELECT seq, name, platform, arch FROM change_log WHERE seq > ? ORDER BY seq", (after_seq, ))
+
+    def last_change_seq(self) -> int:
+        return self.get_execute_result(False, "SELECT COALESCE(MAX(seq), 0) FROM change_log")[0]
+
+    def prune_changes(self, keep: int):
+        """只保留最近的 keep 条改动记录"""
+        self.execute("DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?", (keep, ))
+
+    def data_version(self) -> int:
+        """其他连接提交了改动后会变"""
+        return self.get_execute_result(False, "PRAGMA data_version")[0]
+
+    def get_lru_item(self, keep_id: int = -1):
+        """返回最应该淘汰的 (id, abs_path, size, blob_hash)，不会是 keep_id"""
+        return self.get_execute_result(False, DBHandle.select_lru_item, (keep_id, ))
 
 
 class Data():
+    """下载项和缓存情况以内存目录为准，查询不经过数据库；数据库只用于持久化，改动先写入数据库再更新目录。
+    多个进程共用数据库时，每次改动缓存都记入 change_log，各进程用 sync 读入别的进程的改动。
+    启动后数据库操作都在一个专用线程里依次执行，文件检查用默认线程池，都不占用事件循环；内存目录只在事件循环里改动。
+    数据库线程只有一个，先提交的操作先回到事件循环，目录不会被较旧的数据库内容覆盖"""
+    # 不再被引用的文件过这么久（秒）再删除，正在发送它的请求还能打开
+    unlink_delay = 60
+    # 内容表里没有、且这么久（秒）没动过的 blob 文件，是进程退出前没来得及删除的，启动时清理
+    orphan_age = 3600
+    # 启动时保留的改动记录条数
+    change_log_keep = 10000
+
     def __init__(self, config: Config) -> None:
         if not os.path.exists(config.items_file_path):   # 下载项目不存在，直接退出
             sys.exit("Warning! There is no items config file.")
         self.logger = logging.getLogger(self.__class__.__name__)
         self.config: Config = config
         self.yaml = ruamel.yaml.YAML()
-        # 每个表有变动时刷新
+        self.catalog: dict[ItemLocation, CatalogRecord] = {}
+        self._by_buf_id: dict[int, CatalogRecord] = {}
+        self._accessed: set[CatalogRecord] = set()   # 有访问还没写回数据库的
+        # 网页展示用，每个下载项名称一个字典，目录变动时只更新相应的那个
         self.categories: dict[str, list[dict[str, str]]] = {}
+        self._web_items: dict[str, dict] = {}
+        self._name_records: dict[str, list[CatalogRecord]] = {}
+        self.generation = 0   # 网页展示的内容每变一次加一
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"   # 持有租约时的身份
+        self._db_executor = ThreadPoolExecutor(1, thread_name_prefix="data-db")
+        self._pending_removals: dict[asyncio.TimerHandle, tuple[str, str | None]] = {}   # 还没到时间删除的文件
+        self._sync_lock = asyncio.Lock()
+        self.delta_pending = asyncio.Event()   # 有新的补丁要算
         self.db = DBHandle(config)
+        # 以下在启动时进行，还没有事件循环，直接执行
         self.db.execute(DBHandle.create_dl_buf_table_if_not)
-        self.reload_items()
+        self.db.execute(DBHandle.create_blob_table_if_not)
+        self.db.execute(DBHandle.create_url_blob_table_if_not)
+        self.db.execute(DBHandle.create_lease_table_if_not)
+        self.db.execute(DBHandle.create_change_log_if_not)
+        self.db.execute(DBHandle.create_items_table_if_not)
+        self.db.execute(DBHandle.create_delta_table_if_not)
+        self.db.add_missing_columns("dl_buf_table", DBHandle.dl_buf_table_added_columns)
+        self.db.add_missing_columns("url_blob_table", DBHandle.url_blob_table_added_columns)
+        self.db.add_missing_columns("items_table", DBHandle.items_table_added_columns)
+        self.db.executescript(DBHandle.create_indexes)
+        self.db.prune_changes(Data.change_log_keep)
+        self._fill_missing_sizes()
+        if not config.delta_updates:
+            self._drop_all_deltas()
+        self._remove_orphan_files("blobs", self.db.get_blob_hashes())
+        self._remove_orphan_files("deltas", self.db.get_delta_filenames())
+        self._data_version = self.db.data_version()
+        self._change_seq = self.db.last_change_seq()   # 在载入目录之前取，期间的改动会在下次 sync 时读入
+        self._items_mtimes = self._get_mtimes()
+        self._write_items()
+        self._apply_catalog(self.db.get_execute_result(True, DBHandle.select_catalog))
 
-    def insert_item_to_db(self, *args, **kwargs):
-        self.db.insert_item_to_buf(*args, **kwargs)
-        self.update_categories()
+    async def _db(self, func, *args):
+        """在数据库线程里执行，带上当前的上下文，慢请求日志仍能记下其中 SQL 的耗时"""
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, context.run, func, *args)
+
+    def shutdown(self):
+        """等数据库线程做完手上的事；还没到时间删除的文件这时就删，已经没有请求在发送它们，不必留给下次启动清理"""
+        pending = list(self._pending_removals.items())
+        self._pending_removals.clear()
+        for handle, _ in pending:
+            handle.cancel()
+        self._db_executor.shutdown(wait=True)
+        for _, args in pending:
+            self._remove_if_unused(*args)
+
+    async def update_item_in_db(self, item: ItemInfo, version, artifact: Artifact):
+        item_location = ItemLocation(item.name, item.platform, item.arch)
+        now = db_now()
+        buf_id, unused_files, delta_added = await self._db(self._write_item, item, version, artifact, now)
+        for unused in unused_files:
+            self._remove_file_later(*unused)
+        if delta_added:
+            self.delta_pending.set()
+        record = self.catalog.get(item_location)
+        if record:   # 下载期间重载了下载项，这一项可能已被删除
+            self._by_buf_id.pop(record.buf_id, None)
+            record.set_buf(buf_id, version, now, now, artifact.path, artifact.filename, artifact.digest, artifact.size)
+            self._by_buf_id[buf_id] = record
+            self._update_web_item(record.name)
+
+    def _write_item(self, item: ItemInfo, version, artifact: Artifact, now: str):
+        """返回这一项的行 id、应删除的文件，以及是否要为它计算补丁"""
+        item_location = ItemLocation(item.name, item.platform, item.arch)
+        delta_added = False
+        with self.db.transaction():
+            self.db.acquire_blob(artifact)
+            row = self.db.get_buf_row(item_location)   # 以数据库为准，其他进程可能刚淘汰了它
+            if row:
+                buf_id, old_version, old_path, old_hash = row[0], row[1], row[4], row[6]
+                self.db.update_item_in_buf(buf_id, version, artifact.path, artifact.size, artifact.filename, artifact.digest, now)
+                unused_files = self._drop_delta(item_location)   # 到旧版本的补丁没用了
+                if self.config.delta_updates and old_hash and old_hash != artifact.digest and old_version != version:
+                    # 旧版本的文件不再被这一行引用，改由补丁占着，算完补丁再释放
+                    self.db.insert_delta(item_location, old_version, old_hash, artifact.digest)
+                    delta_added = True
+                else:
+                    unused_files += self._release_file(old_path, old_hash)
+            else:
+                buf_id = self.db.insert_item_to_buf(item.name, item.platform, item.arch, version, artifact.path, artifact.size,
+                                                    artifact.filename, artifact.digest, now)
+                unused_files = []
+            self.db.log_change(item_location)
+        return buf_id, unused_files, delta_added
+
+    async def find_blob_by_url(self, url: str) -> Artifact | None:
+        """该直链上次下载的内容还存有，则返回它（filename 为空）"""
+        res = await self._db(self.db.get_blob_by_url, url)
+        if res and await asyncio.to_thread(os.path.isfile, res[1]):
+            return Artifact(res[1], "", res[0], res[2], url, res[3] or "", res[4] or "")
+        return None
 
-    def update_item_in_db(self, item: ItemInfo, version, filepath):
-        info = self.db.get_item_from("dl_buf_table", ItemLocation(item.name, item.platform, item.arch))
-        if info:
-            self.db.update_item_in_buf(item.buf_id, version, filepath)
+    async def get_and_check_path_from_db(self, item_location: ItemLocation) -> tuple[str, str]:
+        """返回路径和给客户端的文件名，没有则都为空。访问记录先留在内存，淘汰和退出前再写回数据库"""
+        record = self.catalog.get(item_location)
+        if not record or record.buf_id is None:
+            return "", ""
+
+        if not await asyncio.to_thread(os.path.isfile, record.abs_path):
+            await self.sync()   # 可能是其他进程更新或淘汰了它
+            if record.buf_id is None:
+                return "", ""
+            if not await asyncio.to_thread(os.path.isfile, record.abs_path):
+                await self._del_buf_row(record.buf_id, record.abs_path, record.blob_hash)
+                return "", ""
+        if record.buf_id is None:   # 检查期间被淘汰了
+            return "", ""
+        record.accessed_at = time.time()
+        record.pending_hits += 1
+        self._accessed.add(record)
+        return record.abs_path, record.filename or os.path.basename(record.abs_path)
+
+    def get_digest(self, item_location: ItemLocation) -> str:
+        """缓存内容的 sha256，旧版本留下的文件没有记录则为空"""
+        record = self.catalog.get(item_location)
+        return (record.blob_hash or "") if record else ""
+
+    def get_last_modified(self, item_location: ItemLocation) -> int:
+        """缓存内容在这一项下更新的时间（Unix 秒），没有记录则为 0。blob 文件被多行共用或重复使用，其修改时间不能代表这一项"""
+        record = self.catalog.get(item_location)
+        if not record or not record.last_modified:
+            return 0
+        return int(datetime.strptime(record.last_modified, db_time_format).replace(tzinfo=timezone.utc).timestamp())
+
+    async def flush_accesses(self):
+        """把内存中的访问时间和次数写回数据库"""
+        if not self._accessed:
+            return
+        rows = [(datetime.fromtimestamp(r.accessed_at, timezone.utc).strftime(db_time_format), r.pending_hits, r.buf_id)
+                for r in self._accessed if r.buf_id is not None]
+        for record in self._accessed:   # 先清掉，写入期间的新访问留到下一次
+            record.accessed_at, record.pending_hits = None, 0
+        self._accessed.clear()
+        await self._db(self.db.save_accesses, rows)
+
+    def _release_file(self, abs_path: str, blob_hash: str | None) -> list[tuple[str, str | None]]:
+        """一行不再引用其文件，已无人引用时返回应删除的文件路径和哈希"""
+        if blob_hash:
+            unused = self.db.release_blob(blob_hash)
+            return [(unused, blob_hash)] if unused else []
+        return [(abs_path, None)]   # 旧版本留下的、不按内容寻址的文件只属于这一行
+
+    def _drop_delta(self, item_location: ItemLocation) -> list[tuple[str, str | None]]:
+        """在事务中删除这个位置的补丁，返回应删除的文件"""
+        row = self.db.get_delta(item_location)
+        if not row:
+            return []
+        id, _, from_hash, _, patch_path, _ = row
+        self.db.execute("DELETE FROM delta_table WHERE id = ?", (id, ))
+        if patch_path is None:   # 还没算出，释放它占着的旧内容
+            return self._release_file("", from_hash)
+        return [(patch_path, None)] if patch_path else []
+
+    def _drop_all_deltas(self):
+        """关闭补丁后，启动时删掉所有补丁，不再占着旧内容"""
+        unused_files = []
+        with self.db.transaction():
+            for row in self.db.get_execute_result(True, "SELECT name, platform, arch FROM delta_table"):
+                unused_files += self._drop_delta(ItemLocation(*row))
+        for unused in unused_files:
+            self._remove_if_unused(*unused)
+
+    def _delete_buf_row(self, id: int, abs_path: str, blob_hash: str | None) -> list[tuple[str, str | None]]:
+        """在事务中删除一行，返回应删除的文件；这一行已被其他进程删除或更新时什么也不做"""
+        row = self.db.get_execute_result(False, "SELECT name, platform, arch FROM dl_buf_table WHERE id=?", (id, ))
+        if not row or not self.db.del_item_in_buf_by_id(id, abs_path):
+            return []
+        self.db.log_change(ItemLocation(*row))
+        return self._release_file(abs_path, blob_hash) + self._drop_delta(ItemLocation(*row))
+
+    def _delete_buf_row_now(self, id: int, abs_path: str, blob_hash: str | None):
+        with self.db.transaction():
+            return self._delete_buf_row(id, abs_path, blob_hash)
+
+    async def _del_buf_row(self, id: int, abs_path: str, blob_hash: str | None) -> None:
+        for unused in await self._db(self._delete_buf_row_now, id, abs_path, blob_hash):
+            self._remove_file_later(*unused)
+        await self._forget_buf_row(id)
+
+    async def _forget_buf_row(self, id: int):
+        record = self._by_buf_id.get(id)
+        if record:
+            self._set_record_buf(record, await self._db(self.db.get_buf_row, record.location))
+
+    def _remove_file_later(self, abs_path: str, blob_hash: str | None):
+        """正在发送这个文件的请求可能还没打开它，过一会儿再在数据库线程里删除"""
+        handle = asyncio.get_running_loop().call_later(Data.unlink_delay, lambda: self._start_removal(handle))
+        self._pending_removals[handle] = (abs_path, blob_hash)
+
+    def _start_removal(self, handle: asyncio.TimerHandle):
+        args = self._pending_removals.pop(handle, None)
+        if args:
+            asyncio.get_running_loop().run_in_executor(self._db_executor, self._remove_if_unused, *args)
+
+    def _remove_if_unused(self, abs_path: str, blob_hash: str | None):
+        if blob_hash and self.db.has_blob(blob_hash):   # 期间又存入了相同的内容
+            return
+        try:
+            os.remove(abs_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning(f"failed to remove '{abs_path}': {e}")
+
+    def _remove_orphan_files(self, dirname: str, known: set[str]):
+        """删除 blobs 或 deltas 目录下数据库里没有记录的文件"""
+        root = os.path.join(self.config.temp_download_dir, dirname)
+        if not os.path.isdir(root):
+            return
+        deadline = time.time() - Data.orphan_age
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename in known:
+                    continue
+                try:
+                    if os.path.getmtime(path) >= deadline:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:   # 同时启动的其他进程已经删掉了
+                    continue
+                self.logger.info(f"removed orphan file '{dirname}/{filename}'")
+
+    async def sync(self) -> bool:
+        """读入其他进程对缓存的改动，返回是否有改动。没有其他连接提交过时只执行一条 PRAGMA"""
+        async with self._sync_lock:   # 同时调用时只读一次，后来的等前面的读完
+            res = await self._db(self._read_changes, self._data_version, self._change_seq)
+            if res is None:
+                return False
+            self._data_version, changes, catalog_rows, buf_rows = res
+            if not changes:
+                return False
+            self._change_seq = changes[-1][0]
+            if catalog_rows is not None:   # 其他进程重载了下载项
+                self._apply_catalog(catalog_rows)
+            for item_location, row in buf_rows.items():
+                record = self.catalog.get(item_location)
+                if record:
+                    self._set_record_buf(record, row)
+            return True
+
+    def _read_changes(self, data_version: int, change_seq: int):
+        """读出 change_seq 之后的改动和改动涉及的行，数据库没有变化时返回 None"""
+        current = self.db.data_version()
+        if current == data_version:
+            return None
+        changes = self.db.get_changes(change_seq)
+        catalog_rows = None
+        if any(row[1] is None for row in changes):
+            catalog_rows = self.db.get_execute_result(True, DBHandle.select_catalog)
+        locations = {ItemLocation(*row[1:]) for row in changes if row[1] is not None}
+        return current, changes, catalog_rows, {loc: self.db.get_buf_row(loc) for loc in locations}
+
+    def _set_record_buf(self, record: CatalogRecord, row: tuple | None):
+        """按数据库中的行重新设置这一项的缓存情况"""
+        if self._by_buf_id.get(record.buf_id) is record:
+            del self._by_buf_id[record.buf_id]
+        if row:
+            if row[0] != record.buf_id:
+                self._accessed.discard(record)
+            record.set_buf(*row)
+            self._by_buf_id[record.buf_id] = record
         else:
-            self.db.insert_item_to_buf(item.name, item.platform, item.arch, version, filepath)
-        self.update_categories()
+            record.set_buf(None)
+            self._accessed.discard(record)
+        self._update_web_item(record.name)
 
-    def get_and_check_path_from_db(self, item_location: ItemLocation) -> str:
-        """返回路径"""
-        info = self.db.get_item_from("dl_buf_table", item_location)
-        if not info:
-            return ""
+    async def touch_checked(self, item_location: ItemLocation):
+        record = self.catalog.get(item_location)
+        if not record or record.buf_id is None:
+            return
+        now = db_now()
+        await self._db(self._touch_checked, record.buf_id, item_location, now)
+        record.checked_at = datetime.strptime(now, db_time_format)
 
-        if os.path.isfile(info[-1]):
-            return info[-1]
-        self.db.del_item_in_buf_by_id(info[0])
-        self.update_categories()
-        return ""
+    def _touch_checked(self, buf_id: int, item_location: ItemLocation, now: str):
+        with self.db.transaction():
+            self.db.touch_checked(buf_id, now)
+            self.db.log_change(item_location)
+
+    async def try_lease(self, key: str, ttl: float) -> bool:
+        """取得或延期跨进程的租约，被其他进程持有时返回 False"""
+        return await self._db(self.db.try_lease, key, self.worker_id, ttl)
+
+    async def release_lease(self, key: str | None = None):
+        """key 为 None 时释放本进程的所有租约"""
+        await self._db(self.db.release_lease, key, self.worker_id)
+
+    async def get_pending_deltas(self) -> list[tuple]:
+        """还没算出的补丁：(id, 旧文件, 旧文件大小, 新文件, 新文件大小, 旧内容哈希, 新内容哈希)"""
+        return await self._db(self.db.get_execute_result, True, DBHandle.select_pending_deltas)
+
+    async def finish_delta(self, id: int, patch_path: str, size: int, patch_hash: str):
+        """记下算出的补丁，patch_path 为空表示不用补丁；然后释放补丁占着的旧内容"""
+        for unused in await self._db(self._finish_delta, id, patch_path, size, patch_hash):
+            self._remove_file_later(*unused)
+
+    def _finish_delta(self, id: int, patch_path: str, size: int, patch_hash: str):
+        with self.db.transaction():
+            row = self.db.get_execute_result(False, "SELECT from_hash FROM delta_table WHERE id = ? AND patch_path IS NULL", (id, ))
+            if not row:   # 计算期间又有了新版本，或者被淘汰了
+                return [(patch_path, None)] if patch_path else []
+            self.db.execute("UPDATE delta_table SET patch_path = ?, size = ?, patch_hash = ? WHERE id = ?",
+                            (patch_path, size, patch_hash, id))
+            return self._release_file("", row[0])
+
+    async def find_delta(self, item_location: ItemLocation, from_version: str) -> tuple[str, str, str] | None:
+        """从 from_version 到当前缓存内容的补丁，返回补丁的路径、补丁的哈希和目标内容的哈希，没有则返回 None"""
+        record = self.catalog.get(item_location)
+        if not record or not record.blob_hash or from_version == record.version:
+            return None
+        row = await self._db(self.db.get_delta, item_location)
+        if not row:
+            return None
+        _, delta_from_version, _, to_hash, patch_path, patch_hash = row
+        if delta_from_version != from_version or to_hash != record.blob_hash or not patch_path:
+            return None
+        if not await asyncio.to_thread(os.path.isfile, patch_path):
+            return None
+        return patch_path, patch_hash, to_hash
 
-    def _get_item_info(self, item_location: ItemLocation):
-        res = self.db.get_item_from("items_table", item_location)
-        return ItemInfo(*res[1:], None, None, None) # type: ignore
+    def get_refresh_rows(self):
+        """所有下载项的位置、网站、项目名、过期天数、是否已缓存以及上次检查的时间"""
+        return [(loc, r.website, r.project_name, r.stale_duration, r.buf_id is not None, r.checked_at) for loc, r in self.catalog.items()]
 
-    def get_item_situation(self, item_location: ItemLocation):
-        res = self.db.get_execute_result(False, DBHandle.get_item_situation, item_location)
-        if res:
-            datetime_obj = datetime.strptime(res[11], "%Y-%m-%d %H:%M:%S")
-            return ItemInfo(name=res[1], image=None, category=None, website=res[2], project_name=res[3], homepage=res[13], sample_url=res[4], platform=res[5], arch=res[6], original_platform=res[7], original_arch=res[8], suffix_name=res[9], formated_dl_url=None, staleDurationDay=res[12], version=res[10], last_modified=datetime_obj, buf_id=res[0])
-        return self._get_item_info(item_location)
+    def get_item_situation(self, item_location: ItemLocation) -> ItemInfo | None:
+        """不在下载项中则返回 None"""
+        record = self.catalog.get(item_location)
+        return record.to_item_info() if record else None
 
-    def reload_items(self):
+    def items_files(self) -> list[str]:
+        files = [self.config.items_file_path]
+        if self.config.example_items != self.config.items_file_path:
+            files.append(self.config.example_items)
+        return files
+
+    async def items_changed(self) -> bool:
+        """下载项配置文件在上次重载后有没有改动，只比较修改时间"""
+        return await asyncio.to_thread(self._get_mtimes) != self._items_mtimes
+
+    def _get_mtimes(self) -> tuple:
+        return tuple(os.stat(f).st_mtime_ns if os.path.exists(f) else None for f in self.items_files())
+
+    async def reload_items(self) -> int:
+        """按下载项配置增量更新 items_table 和内存目录，返回改动的行数。没变的下载项及其缓存不受影响"""
+        self._items_mtimes = await asyncio.to_thread(self._get_mtimes)   # 先记下，配置有误时不会每次检查都重试
+        await self.flush_accesses()
+        changed = await self._db(self._write_items)
+        if changed:
+            self._apply_catalog(await self._db(self.db.get_execute_result, True, DBHandle.select_catalog))
+            self.logger.info(f"reloaded items, {changed} rows changed")
+        return changed
+
+    def _write_items(self) -> int:
+        """读取下载项配置并写入 items_table，返回改动的行数"""
+        rows = self._expand_items(self._read_items())
+        with self.db.transaction():   # 多个进程同时重载时依次进行，后面的就没有改动了
+            changed = self.db.apply_items(rows)
+            if changed:
+                self.db.log_change(ItemLocation(None, None, None))
+        return changed
+
+    def _read_items(self) -> dict:
         items = self._reload(self.config.items_file_path)
         if self.config.example_items != self.config.items_file_path:
             example_items = self._reload(self.config.example_items)
             for name in example_items:
                 if name not in items:
                     items[name] = example_items[name]
+        return items
 
-        self.db.execute("DROP TABLE IF EXISTS items_table")
-        self.db.execute(DBHandle.create_items_table_if_not)
+    def _expand_items(self, items: dict) -> list[tuple]:
+        """展开成 items_table 的行，顺序同 DBHandle.items_table_columns"""
+        rows = []
         for name, item in items.items():
             homepage = self._get_homepage(item)
             category = item.get("category", self.config.default_category)
             image = item.get("image", self.config.default_image)
             for ((platform, arch), (ori_platform, ori_arch), suffix_name) in self._get_system_archs(item):
                 formated_dl_url = f"/download/?name={name}&platform={platform}&arch={arch}"
-                self.db.execute("INSERT INTO items_table (name, image, category, website, project_name, homepage, sample_url, "
-                    "platform, arch, original_platform, original_arch, suffix_name, formated_dl_url, stale_duration)"
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (name, image, category, item["website"], item.get("project_name", ""), homepage, item.get("sample_url", ""), 
-                    platform, arch, ori_platform, ori_arch, suffix_name, formated_dl_url, item.get("staleDurationDay", 1))
-                )
+                rows.append((name, image, category, item["website"], item.get("project_name", ""), homepage, item.get("sample_url", ""),
+                             platform, arch, ori_platform, ori_arch, suffix_name, formated_dl_url, item.get("staleDurationDay", 1),
+                             int(item.get("pinned", False))))
+        return rows
+
+    def _apply_catalog(self, rows: list[tuple]):
+        """按 select_catalog 的结果增量更新内存目录：保留没变的下载项，更新改了的，加上新的，去掉删除的。
+        已有下载项的缓存情况不从这里取，它由 sync 和本进程的改动维护"""
+        catalog_rows = {}
+        for row in rows:
+            catalog_rows.setdefault(ItemLocation(row[0], row[7], row[8]), row)   # 同一位置有多行缓存时用第一行
+        for item_location in [loc for loc in self.catalog if loc not in catalog_rows]:
+            record = self.catalog.pop(item_location)
+            if self._by_buf_id.get(record.buf_id) is record:
+                del self._by_buf_id[record.buf_id]
+            self._accessed.discard(record)
+        for item_location, row in catalog_rows.items():
+            record = self.catalog.get(item_location)
+            if record:
+                record.set_item(row[:15])
+                continue
+            record = self.catalog[item_location] = CatalogRecord(row[:15], row[15:])
+            if record.buf_id is not None:
+                self._by_buf_id[record.buf_id] = record
         self.update_categories()
 
     def update_categories(self):
-        categories = {}
-        res = self.db.get_execute_result(True, DBHandle.get_web_elements)
-        res.sort(key=lambda item : item[0])
-        for name, items in groupby(res, key=lambda item : item[0]):
-            downloads = []
-            for item in items:
-                downloads.append({
-                    "platform": item[4],
-                    "architecture": item[5],
-                    "link": item[6],
-                })
-            category = item[1]
-            if not categories.get(category):
-                categories[category] = []
-            categories[category].append({
+        """按目录重建网页展示的全部内容"""
+        categories, web_items, name_records = {}, {}, {}
+        for record in sorted(self.catalog.values(), key=lambda r: r.name):
+            name_records.setdefault(record.name, []).append(record)
+        for name, records in name_records.items():
+            item = records[-1]
+            web_item = web_items[name] = {
                 "name": name,
-                "category": category,
-                "website": item[2],
-                "image": item[3],
-                "downloads": downloads,
-                "version": item[7],
-                "last_modified": item[8],
-            })
-        self.categories = categories
-
-    def check_and_handle_max_space(self) -> None:
-        if int(self.db.get_execute_result(False, "SELECT COUNT(*) FROM dl_buf_table")[0]) <= 1:
+                "category": item.category,
+                "website": item.homepage,
+                "image": item.image,
+                "downloads": [{"platform": r.platform, "architecture": r.arch, "link": r.formated_dl_url} for r in records],
+            }
+            categories.setdefault(item.category, []).append(web_item)
+        self.categories, self._web_items, self._name_records = categories, web_items, name_records
+        for name in name_records:
+            self._update_web_item(name)
+
+    def _update_web_item(self, name: str):
+        """只更新这个名称的版本和更新时间，展示最近更新的那个缓存"""
+        web_item = self._web_items.get(name)
+        if web_item is None:
             return
-        if Data._get_directory_size_mb(self.config.temp_download_dir) >= self.config.max_buf_space_mb:
-            res = self.db.get_oldest_item()
-            self.db.del_item_in_buf_by_id(res[0])
-            os.remove(res[1])
-
-    @staticmethod
-    def _get_directory_size_mb(directory):
-        """计算目录下所有文件的总大小"""
-        total_size = 0
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    total_size += os.path.getsize(file_path)
-                except OSError as e:
-                    print(f"无法访问文件 {file_path}: {e}")
-        return total_size / 1024 / 1024
+        cached = [r for r in self._name_records[name] if r.buf_id is not None]
+        latest = max(cached, key=lambda r: r.last_modified or "") if cached else None
+        web_item["version"] = latest.version if latest else None
+        web_item["last_modified"] = latest.last_modified if latest else None
+        self.generation += 1
+
+    async def get_buf_size(self) -> int:
+        """缓存中所有文件的总大小（字节），按记录的大小累加，不扫描目录"""
+        return await self._db(self.db.get_buf_size)
+
+    async def get_buf_size_mb(self) -> float:
+        return await self.get_buf_size() / 1024 / 1024
+
+    async def check_and_handle_max_space(self, keep: ItemLocation | None = None) -> None:
+        """超出缓存空间时，按最近最少使用依次淘汰，直到回到限制以内。keep 是刚下载的，不淘汰它，
+        因此当缓存中只有一个文件时，这个文件的大小可以超出缓存"""
+        record = self.catalog.get(keep) if keep else None
+        keep_id = record.buf_id if record and record.buf_id is not None else -1
+        max_bytes = self.config.max_buf_space_mb * 1024 * 1024
+        if await self._db(self.db.get_buf_size) <= max_bytes:
+            return
+        await self.flush_accesses()   # 按最新的访问时间挑选
+        evicted, unused_files = await self._db(self._evict, keep_id, max_bytes)
+        for unused in unused_files:
+            self._remove_file_later(*unused)
+        for id in evicted:
+            await self._forget_buf_row(id)
+        EVICTIONS.inc(len(evicted))
+
+    def _evict(self, keep_id: int, max_bytes: int):
+        """在一个事务中挑选和删除，多个进程同时淘汰时依次进行，不会多删。返回删除的行 id 和应删除的文件"""
+        evicted, unused_files = [], []
+        with self.db.transaction():
+            used = self.db.get_buf_size()
+            while used > max_bytes:
+                res = self.db.get_lru_item(keep_id)
+                if not res:
+                    break
+                id, abs_path, size, blob_hash = res
+                unused_files += self._delete_buf_row(id, abs_path, blob_hash)
+                evicted.append(id)
+                used = self.db.get_buf_size()   # 内容还被其他行引用时，并不能腾出空间
+                self.logger.info(f"evict '{os.path.basename(abs_path)}', {used / 1024 / 1024:.1f} MB used")
+        return evicted, unused_files
+
+    def _fill_missing_sizes(self):
+        """旧数据库没有记录文件大小，启动时补上一次"""
+        for id, abs_path in self.db.get_execute_result(True, "SELECT id, abs_path FROM dl_buf_table WHERE size IS NULL"):
+            size = os.path.getsize(abs_path) if os.path.isfile(abs_path) else 0
+            self.db.execute("UPDATE dl_buf_table SET size = ? WHERE id = ?", (size, id))
 
     def _make_sure_file_format(self) -> None:
         """确保文件的格式正确"""
@@ -1,13 +1,25 @@
+import asyncio
 import logging
 import os
-import httpx
 import aiofiles
+import httpx
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
 
 import jinja2
 
-from dataHandle import ItemInfo
+from dataHandle import Artifact, ItemInfo, get_blob_path
 from configHandle import config
+from Metrics import DOWNLOAD_BYTES, timed
+from downloader.Staging import IncompleteDownload, StagedDownload
+from downloader.Transfer import Transfer
+from downloader.HttpPool import HttpPool
+from downloader.VersionCache import VersionCache
+
+# 所有下载器共用的连接池和最新版本缓存
+http_pool = HttpPool(config.concurrent_amount, config.upstream_override)
+version_cache = VersionCache()
 
 class NotFound(Exception):
     """未能根据传入的信息找到相应的资源"""
@@ -17,25 +29,69 @@ class APILimitException(Exception):
     """GitHub 网页请求限制"""
     pass
 
+class InvalidURL(Exception):
+    """下载直链第一跳的状态码不是预期的"""
+    pass
+
+class NotModified(Exception):
+    """条件请求得知上游的内容没有变化"""
+    pass
+
+class RangeIgnored(IncompleteDownload):
+    """分段下载时上游没有按 Range 给出这一段，改为按顺序下载整个文件"""
+    pass
+
 
 class AbstractDownloader(ABC):
     """描述下载所有网站都需要的内容，单个实例可以并发下不同的下载项"""
     environment = jinja2.Environment()
+    chunk_size = 64 * 1024   # 流式下载时每次写入的块大小
+    immutable_urls = True   # 同一个下载直链的内容是否永远不变，是则已存有其内容时不必再下载
+    max_retries = 3   # 一次下载里，上游中断后最多续传的次数
+    retry_backoff = 2   # 第 n 次重试前等待 retry_backoff ** n 秒
+    staging_max_age = 7 * 86400   # 暂存区里这么久没动过的部分下载会被清理
+    valid_codes: tuple[int, ...] = (200, )   # 有效的下载直链，第一跳（不跟随跳转）应返回的状态码
+    no_segment_hosts: set[str] = set()   # 声明支持 Range 却不按 Range 给内容的主机，不再对它们分段下载
 
-    def __init__(self, download_dir, api_token=None):
+    def __init__(self, download_dir, api_token=None, find_blob: Callable[[str], Awaitable[Artifact | None]] | None = None):
         self.download_dir = download_dir
         self.api_token = api_token
+        self.find_blob = find_blob   # 根据下载直链查找已存的内容
         self.logger = logging.getLogger(self.__class__.__name__)
 
-    async def __call__(self, item_info: ItemInfo):
-        """调用以上命令，串联工作流程，出错则返回空字符串 filepath"""
-        latest_version = await self.__class__.get_latest_version(item_info, self.api_token)
+    async def __call__(self, item_info: ItemInfo, transfer: Transfer | None = None):
+        """调用以上命令，串联工作流程，出错则返回的 artifact 为 None。传入 transfer 则对外公布下载进度"""
+        website = item_info.website
+        with timed(website, "get_latest_version"):
+            latest_version = await self.__class__.get_latest_version(item_info, self.api_token)
         if not self.__class__._is_out_of_date(latest_version, item_info.version):
-            return "", ""
+            return None, ""
         filename = f"{item_info.name}-{item_info.platform}-{item_info.arch}-{latest_version.replace(r'%2F', '-')}{item_info.suffix_name}"
         url = self.__class__.format_url(item_info, latest_version)
-        filepath = await AbstractDownloader.downloading(self.logger, url, filename, self.download_dir, self.__class__.is_valid_url)
-        return filepath, latest_version
+        stored = await self.find_blob(url) if self.find_blob else None
+        if stored and self.__class__.immutable_urls:
+            self.logger.info(f"reuse stored content for '{filename}': {url}")
+            return stored._replace(filename=filename), latest_version
+        # 内容会变的直链，用上次下载时的校验值做条件请求；这一项缓存的不是该直链上次的内容时，不能据此判断
+        if stored and item_info.buf_id is not None and stored.digest != item_info.blob_hash:
+            stored = None
+        segments = config.max_segments.get(website, 1)
+        try:
+            with timed(website, "download"):
+                artifact = await AbstractDownloader.downloading(self.logger, url, filename, self.download_dir, self.__class__.is_valid_response,
+                                                                transfer, segments, AbstractDownloader.conditional_headers(stored))
+        except NotModified:
+            artifact = stored
+        else:
+            if artifact:
+                DOWNLOAD_BYTES.labels(website).observe(artifact.size)
+        # 内容会变的直链，上游没给校验值时，下载后比较哈希
+        if not self.__class__.immutable_urls and artifact and artifact.digest in (item_info.blob_hash, stored and stored.digest):
+            self.logger.info(f"'{filename}' is not modified upstream")
+            if artifact.digest == item_info.blob_hash:
+                return None, ""
+            return artifact._replace(filename=filename), latest_version
+        return artifact, latest_version
 
     @classmethod
     @abstractmethod
@@ -54,20 +110,23 @@ class AbstractDownloader(ABC):
         template = AbstractDownloader.environment.from_string(example_url)
         return template.render(kargs)
 
-    @staticmethod
-    async def _is_valid_code(url: str, valid_codes: list) -> bool:
-        """根据状态码，判断网址是否有效"""
-        async with httpx.AsyncClient() as client:
-            response = await client.head(url)
-            if response.status_code in valid_codes:
-                return True
-            return False
-
     @classmethod
-    @abstractmethod
-    async def is_valid_url(cls, download_url) -> bool:
-        """检查下载直链是否有效"""
-        raise NotImplementedError
+    def is_valid_response(cls, resp: httpx.Response) -> bool:
+        """根据第一跳的状态码判断下载直链是否有效。直接给内容的上游在续传时会返回 206 或 416，条件请求时会返回 304"""
+        if resp.status_code in (206, 304, 416) and 200 in cls.valid_codes:
+            return True
+        return resp.status_code in cls.valid_codes
+
+    @staticmethod
+    def conditional_headers(stored: Artifact | None) -> dict[str, str]:
+        if not stored:
+            return {}
+        headers = {}
+        if stored.etag:
+            headers["If-None-Match"] = stored.etag
+        if stored.last_modified:
+            headers["If-Modified-Since"] = stored.last_modified
+        return headers
 
     @classmethod
     @abstractmethod
@@ -76,27 +135,211 @@ class AbstractDownloader(ABC):
         raise NotImplementedError
 
     @staticmethod
-    async def downloading(logger, url, filename, download_dir, is_valid_url):
+    async def downloading(logger, url, filename, download_dir, is_valid: Callable[[httpx.Response], bool],
+                          transfer: Transfer | None = None, segments: int = 1, conditional: dict[str, str] | None = None) -> Artifact | None:
+        """流式下载到暂存区，边写边计算哈希，完成后落盘并原子改名为按内容寻址的路径。
+        避免整个文件驻留内存或被读到写了一半的文件，相同内容只存一份。中断的下载会续传，失败后留在暂存区，下次接着下。
+        直链是否有效由 is_valid 按下载请求的第一个响应判断，不另发请求。segments 大于 1 时，足够大的文件分成多段同时下载。
+        conditional 为条件请求头，上游回答没有变化时抛出 NotModified"""
         logger.info(f"start to download '{filename}': {url}")
-        v = await is_valid_url(url)
-        if not v:
-            logger.warning(f"{url} is invalid")
-            return ""
-
-        filepath = os.path.join(download_dir, filename)
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            resp = await client.get(url)
+        await asyncio.to_thread(StagedDownload.clean, download_dir, AbstractDownloader.staging_max_age)
+        staged = StagedDownload(download_dir, url)
+        async with staged.exclusive():
             try:
-                resp.raise_for_status()  # 确保请求成功
-                async with aiofiles.open(filepath, 'wb') as f:
-                    await f.write(resp.content)
+                offset = await asyncio.to_thread(staged.load)
+                if offset:
+                    logger.info(f"resume '{filename}' from {offset} bytes")
+                for attempt in range(AbstractDownloader.max_retries + 1):
+                    try:
+                        await AbstractDownloader._download_to_staging(logger, staged, url, filename, is_valid, transfer, segments, conditional or {})
+                        break
+                    except (httpx.TransportError, httpx.HTTPStatusError, IncompleteDownload) as e:
+                        if not AbstractDownloader._is_retryable(e) or attempt == AbstractDownloader.max_retries:
+                            raise
+                        delay = AbstractDownloader.retry_backoff ** (attempt + 1)
+                        logger.warning(f"download of '{filename}' interrupted at {staged.size} bytes: {e!r}, retry in {delay}s")
+                        await asyncio.sleep(delay)
+                digest = staged.hasher.hexdigest()
+                filepath = get_blob_path(download_dir, digest)
+                if transfer:   # 改名之后才加入的客户端打不开暂存文件，要先知道去哪里读
+                    transfer.filepath = filepath
+                if not await asyncio.to_thread(AbstractDownloader._store, staged, filepath):
+                    logger.info(f"'{filename}' is identical to stored {digest[:12]}")
+                if transfer:
+                    transfer.finish(True, filepath)
                 logger.info(f"finish to save '{filename}'")
+            except (InvalidURL, NotModified) as e:
+                if not staged.resumable:
+                    await asyncio.to_thread(staged.discard)
+                if transfer:
+                    transfer.finish(False)
+                if isinstance(e, NotModified):
+                    raise
+                logger.warning(str(e))
+                return None
             except Exception as e:
                 msg = f"Error downloading {url}\n" + str(e)
                 logger.error(msg)
                 await config.post2RSS("error log of Downloader", msg)
-                # 删除可能已经部分下载的文件
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                return ""
-        return filepath
+                if staged.resumable:   # 留着已下载的部分，下次续传
+                    logger.info(f"keep {staged.size} bytes of '{filename}' for resuming")
+                else:
+                    await asyncio.to_thread(staged.discard)
+                if transfer:
+                    transfer.finish(False)
+                return None
+        return Artifact(filepath, filename, digest, staged.size, url, staged.etag, staged.last_modified)
+
+    @staticmethod
+    def _store(staged: StagedDownload, filepath: str) -> bool:
+        """把下载完的文件移到按内容寻址的路径，已有相同内容时丢掉它，返回是否新存入"""
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        stored = not os.path.isfile(filepath)
+        if stored:
+            os.replace(staged.part_path, filepath)
+        else:
+            os.remove(staged.part_path)
+        staged.discard()
+        return stored
+
+    @staticmethod
+    @asynccontextmanager
+    async def _stream_valid(url: str, headers: dict, is_valid: Callable[[httpx.Response], bool]):
+        """流式 GET，第一跳不跟随跳转，先按状态码检查直链，无效时不读内容就放弃；有效则跟随跳转到最终的响应"""
+        client = http_pool.client
+        resp = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+        try:
+            if not is_valid(resp):
+                raise InvalidURL(f"{url} is invalid, got status {resp.status_code}")
+            if resp.next_request is not None:
+                await resp.aclose()
+                resp = await client.send(resp.next_request, stream=True, follow_redirects=True)
+            yield resp
+        finally:
+            await resp.aclose()
+
+    @staticmethod
+    async def _download_to_staging(logger, staged: StagedDownload, url: str, filename: str, is_valid: Callable[[httpx.Response], bool],
+                                   transfer: Transfer | None, segments: int, conditional: dict[str, str]):
+        """请求一次上游，能续传则追加到暂存文件后面，能分段则改为分段下载，否则从头写"""
+        segmented_url = ""
+        async with AbstractDownloader._stream_valid(url, {**conditional, **staged.range_headers()}, is_valid) as resp:
+            # 不理会条件请求的上游，给出的 ETag 相同也说明没有变化，不必读内容
+            if_none_match = conditional.get("If-None-Match")
+            if resp.status_code == 304 or (resp.status_code == 200 and if_none_match and resp.headers.get("etag") == if_none_match):
+                raise NotModified()
+            if resp.status_code == 416:
+                if staged.complete:   # 上次其实已经下完了
+                    return
+                AbstractDownloader._fail_followers(transfer)
+                await asyncio.to_thread(staged.reset)
+                raise IncompleteDownload("range not satisfiable, restart from the beginning")
+            resp.raise_for_status()  # 确保请求成功
+            if resp.status_code == 206 and not staged.accepts(resp):
+                AbstractDownloader._fail_followers(transfer)
+                await asyncio.to_thread(staged.reset)
+                raise IncompleteDownload(f"unexpected content range {resp.headers.get('content-range')}")
+            if not staged.accepts(resp):
+                AbstractDownloader._fail_followers(transfer)
+                await asyncio.to_thread(staged.restart, resp)
+                # 有客户端在等着边下边读时，只能按顺序下载
+                if AbstractDownloader._can_segment(resp, staged, segments) and not (transfer and transfer.watchers):
+                    segmented_url = str(resp.url)   # 跳转后的地址，各段不必再跳转
+            if not segmented_url:
+                if transfer and not transfer.started:
+                    transfer.start(filename, staged.part_path, staged.length)
+                    transfer.advance(staged.size)
+                async with aiofiles.open(staged.part_path, 'ab') as f:
+                    try:
+                        async for chunk in resp.aiter_bytes(AbstractDownloader.chunk_size):
+                            await f.write(chunk)
+                            staged.hasher.update(chunk)
+                            staged.size += len(chunk)
+                            if transfer:   # 刷到文件里，跟随读取的客户端才能读到
+                                await f.flush()
+                                transfer.advance(len(chunk))
+                    finally:   # 中断时已写入的字节也要落盘，续传从这里开始
+                        await f.flush()
+                        await asyncio.to_thread(os.fsync, f.fileno())
+        if segmented_url:   # 不读这个响应的内容，关掉它改为分段下载
+            try:
+                await AbstractDownloader._download_segmented(logger, staged, segmented_url, filename, segments)
+            except RangeIgnored as e:
+                logger.warning(f"segmented download of '{filename}' failed: {e}, download it in one stream")
+                await AbstractDownloader._download_to_staging(logger, staged, url, filename, is_valid, transfer, 1, conditional)
+        elif staged.length is not None and staged.size < staged.length:
+            raise IncompleteDownload(f"got {staged.size} of {staged.length} bytes")
+
+    @staticmethod
+    def _fail_followers(transfer: Transfer | None):
+        """暂存文件要从头写之前调用：跟随读取的客户端已读到的内容作废，先让它们停下"""
+        if transfer and transfer.written:
+            transfer.finish(False)
+
+    @staticmethod
+    def _can_segment(resp: httpx.Response, staged: StagedDownload, segments: int) -> bool:
+        """上游支持 Range、长度已知、有校验值且文件足够大，才值得分段"""
+        return (segments > 1 and resp.status_code == 200 and resp.headers.get("accept-ranges") == "bytes"
+                and resp.url.host not in AbstractDownloader.no_segment_hosts
+                and staged.length is not None and bool(staged.etag or staged.last_modified)
+                and staged.length >= config.segment_min_size_mb * 1024 * 1024)
+
+    @staticmethod
+    async def _download_segmented(logger, staged: StagedDownload, url: str, filename: str, segments: int):
+        """把文件分成几段同时下载到预先分配好的暂存文件里，每段各自重试，全部完成后再计算整个文件的哈希。
+        文件中间有空洞，中断后不能续传，下次从头下载"""
+        length: int = staged.length # type: ignore
+        await asyncio.to_thread(staged.preallocate)
+        bound = -(-length // segments)
+        ranges = [(start, min(start + bound, length) - 1) for start in range(0, length, bound)]
+        logger.info(f"download '{filename}' in {len(ranges)} segments")
+        tasks = [asyncio.create_task(AbstractDownloader._download_segment(logger, staged, url, start, end)) for start, end in ranges]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:   # 一段失败则停下其他段
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.to_thread(staged.reset)
+            raise
+        await asyncio.to_thread(staged.rehash)
+
+    @staticmethod
+    async def _download_segment(logger, staged: StagedDownload, url: str, start: int, end: int):
+        pos = start
+        for attempt in range(AbstractDownloader.max_retries + 1):
+            try:
+                headers = {"Range": f"bytes={pos}-{end}", "If-Range": staged.etag or staged.last_modified}
+                async with http_pool.client.stream("GET", url, headers=headers, follow_redirects=True) as resp:
+                    resp.raise_for_status()
+                    if resp.status_code != 206 or not resp.headers.get("content-range", "").startswith(f"bytes {pos}-"):
+                        # 校验值没变却给了完整内容，或者给错了范围，说明上游其实不支持 Range
+                        validator = resp.headers.get("etag", "") if staged.etag else resp.headers.get("last-modified", "")
+                        if resp.status_code == 206 or validator == (staged.etag or staged.last_modified):
+                            AbstractDownloader.no_segment_hosts.add(resp.url.host)
+                        raise RangeIgnored(f"content changed or range ignored, got {resp.status_code} {resp.headers.get('content-range')}")
+                    async with aiofiles.open(staged.part_path, 'r+b') as f:
+                        await f.seek(pos)
+                        try:
+                            async for chunk in resp.aiter_bytes(AbstractDownloader.chunk_size):
+                                chunk = chunk[:end + 1 - pos]
+                                await f.write(chunk)
+                                pos += len(chunk)
+                        finally:
+                            await f.flush()
+                if pos > end:
+                    return
+                raise IncompleteDownload(f"segment {start}-{end} stopped at {pos}")
+            except (httpx.TransportError, httpx.HTTPStatusError, IncompleteDownload) as e:
+                if isinstance(e, RangeIgnored) or not AbstractDownloader._is_retryable(e) or attempt == AbstractDownloader.max_retries:
+                    raise
+                delay = AbstractDownloader.retry_backoff ** (attempt + 1)
+                logger.warning(f"segment {start}-{end} interrupted at {pos}: {e!r}, retry in {delay}s")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _is_retryable(e: Exception) -> bool:
+        """网络错误、服务端错误和限流值得重试，其余的状态码重试也没用"""
+        if isinstance(e, httpx.HTTPStatusError):
+            return e.response.status_code >= 500 or e.response.status_code == 429
+        return True
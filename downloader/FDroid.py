@@ -1,20 +1,53 @@
-import httpx
-from bs4 import BeautifulSoup
+import logging
+import os
 
-from downloader.AbstractClass import AbstractDownloader, NotFound
+from downloader.AbstractClass import AbstractDownloader, NotFound, http_pool, version_cache
+from downloader.FDroidIndex import FDroidIndex
+from downloader.VersionCache import VersionCache
 from dataHandle import ItemInfo
+from configHandle import config
+
+# 所有 fdroid 下载项共用的仓库索引，多个进程通过缓存目录里的文件共用
+fdroid_index = FDroidIndex(config.fdroid_index_url, http_pool, os.path.join(config.temp_download_dir, "fdroid-index.json"))
+logger = logging.getLogger("FDroidDownloader")
 
 
 class FDroidDownloader(AbstractDownloader):
     """专门下载 f-droid.org 的 apk"""
+    valid_codes = (200, )   # apk 直接给出内容
     @classmethod
     async def get_latest_version(cls, item_info: ItemInfo, api_token):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(item_info.homepage)
+        # 同一个软件的所有架构共用一次查询
+        key = ("fdroid", item_info.project_name)
+        ttl = VersionCache.ttl_of(item_info.staleDurationDay)
+        arch_versions = await version_cache.get(key, ttl, lambda: cls._get_arch_versions(item_info, ttl))
+        version_code = FDroidIndex.pick(arch_versions, item_info.original_arch)
+        if version_code is None:
+            raise NotFound
+        return version_code
+
+    @classmethod
+    async def _get_arch_versions(cls, item_info: ItemInfo, max_age: float) -> dict[str, str]:
+        """返回每个架构对应的最新版本编号，先查仓库索引，索引里没有再抓取网页"""
+        try:
+            arch_versions = await fdroid_index.get_package(item_info.project_name, max_age)
+        except Exception as e:
+            logger.warning(f"failed to get fdroid index: {e}")
+            arch_versions = None
+        if arch_versions:
+            return arch_versions
+        return await cls._scrape_arch_versions(item_info.homepage)
+
+    @classmethod
+    async def _scrape_arch_versions(cls, homepage: str) -> dict[str, str]:
+        from bs4 import BeautifulSoup   # 只在索引里找不到时才需要
+
+        response = await http_pool.client.get(homepage)
         soup = BeautifulSoup(response.text, "html.parser")
         package_versions = soup.find('div', class_='package-versions')
 
         # 寻找前四个版本的信息
+        arch_versions = {}
         versions_info = package_versions.find_all('li', class_='package-version', limit=4)
         for version_info in versions_info:
             # 找到版本名称和版本编号
@@ -24,23 +57,14 @@ class FDroidDownloader(AbstractDownloader):
             # 找到支持的架构
             native_code_tags = version_info.find('p', class_="package-version-nativecode").find_all('code', class_='package-nativecode')
             for code in native_code_tags:
-                arch = code.text
-                if arch == item_info.original_arch:
-                    # print(f'Version Name: {version_name}, Version Code: {version_code}, Architecture: {arch}')
-                    return version_code
-        raise NotFound
+                arch_versions.setdefault(code.text, version_code)
+        return arch_versions
 
     @classmethod
     def format_url(cls, item_info: ItemInfo, latest_version: str):
         front_part = f"https://f-droid.org/repo/{item_info.project_name}"
         return f"{front_part}_{latest_version}.apk"
 
-    @classmethod
-    async def is_valid_url(cls, url):
-        # 对于 FDroid，有效则是 200
-        valid_codes = [200]
-        return await AbstractDownloader._is_valid_code(url, valid_codes)
-
     @classmethod
     def _is_out_of_date(cls, latest_version: str, cur: str) -> bool:
         return cur != latest_version
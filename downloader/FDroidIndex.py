@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import TYPE_CHECKING
+
+import aiofiles
+
+if TYPE_CHECKING:   # 解析索引的子进程直接运行这个文件，不导入 downloader 包
+    from downloader.HttpPool import HttpPool
+
+
+class FDroidIndex:
+    """F-Droid 仓库的 JSON 索引（index-v1 或 index-v2）。整个仓库只获取一次，
+    压缩成 软件包 -> {架构: 最新版本编号} 的映射，所有 fdroid 下载项都从这里查。
+    给了 cache_path 时，压缩后的映射连同 ETag 存在这个文件里，多个进程共用：持有文件锁的进程才去上游获取，
+    其他进程等它完成后直接读取。index_url 也可以是本地文件路径，方便用固定的索引文件测试"""
+    universal = ""   # 不含原生代码的 apk，所有架构通用
+    lock_poll = 0.5   # 其他进程正在获取索引时，每隔这么久（秒）再试
+
+    def __init__(self, index_url: str, http_pool: "HttpPool", cache_path: str = ""):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.index_url = index_url
+        self.http_pool = http_pool
+        self.cache_path = cache_path
+        self.packages: dict[str, dict[str, str]] = {}
+        self.fetched_at: float | None = None   # 时间戳，各进程通过缓存文件共用
+        self._etag = ""
+        self._last_modified = ""
+        self._lock = asyncio.Lock()
+
+    async def get_package(self, package_name: str, max_age: float) -> dict[str, str] | None:
+        """返回该软件每个架构的最新版本编号，索引超过 max_age 秒则先刷新，不在索引里则返回 None"""
+        if self._is_stale(max_age):
+            async with self._lock:   # 并发的调用只刷新一次
+                if self._is_stale(max_age):
+                    await self.refresh(max_age)
+        return self.packages.get(package_name)
+
+    def _is_stale(self, max_age: float) -> bool:
+        return self.fetched_at is None or time.time() - self.fetched_at > max_age
+
+    async def refresh(self, max_age: float = 0):
+        """重新获取索引。有共用的缓存文件时，其他进程在 max_age 秒内获取过就直接用它的"""
+        if not self.index_url.startswith(("http://", "https://")):
+            self.packages = await FDroidIndex.load(self.index_url)
+            self.fetched_at = time.time()
+            return
+        if not self.cache_path:
+            await self._fetch()
+            return
+
+        from downloader.Staging import lock_file   # 解析索引的子进程用不到，不在文件开头导入
+        fd = await lock_file(self.cache_path + ".lock", FDroidIndex.lock_poll)
+        try:
+            cache = await asyncio.to_thread(FDroidIndex._read_cache, self.cache_path)
+            if cache and (self.fetched_at is None or cache["fetched_at"] > self.fetched_at):
+                self.packages, self.fetched_at = cache["packages"], cache["fetched_at"]
+                self._etag, self._last_modified = cache["etag"], cache["last_modified"]
+            if self._is_stale(max_age):
+                await self._fetch()
+                await asyncio.to_thread(self._write_cache)
+            else:
+                self.logger.info(f"fdroid index loaded from cache, {len(self.packages)} packages")
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    async def _fetch(self):
+        headers = {}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
+        # 索引有几十 MB，先流式写到临时文件，再在子进程里解析
+        fd, tmp_path = await asyncio.to_thread(tempfile.mkstemp, prefix="fdroid-index-", suffix=".json")
+        try:
+            async with aiofiles.open(fd, "wb") as f:
+                async with self.http_pool.client.stream("GET", self.index_url, headers=headers, follow_redirects=True) as resp:
+                    if resp.status_code == 304:
+                        self.logger.info("fdroid index not modified")
+                        self.fetched_at = time.time()
+                        return
+                    resp.raise_for_status()
+                    async for chunk in resp.aiter_bytes(256 * 1024):
+                        await f.write(chunk)
+                    etag, last_modified = resp.headers.get("etag", ""), resp.headers.get("last-modified", "")
+            self.packages = await FDroidIndex.load(tmp_path)
+            self._etag, self._last_modified = etag, last_modified
+            self.fetched_at = time.time()
+            self.logger.info(f"fdroid index refreshed, {len(self.packages)} packages")
+        finally:
+            await asyncio.to_thread(os.remove, tmp_path)
+
+    @staticmethod
+    def _read_cache(cache_path: str) -> dict | None:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self):
+        """先写临时文件再改名，其他进程不会读到写了一半的"""
+        cache = {"etag": self._etag, "last_modified": self._last_modified, "fetched_at": self.fetched_at, "packages": self.packages}
+        part_path = self.cache_path + ".part"
+        with open(part_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, separators=(",", ":"))
+        os.replace(part_path, self.cache_path)
+
+    @staticmethod
+    async def load(path: str) -> dict[str, dict[str, str]]:
+        """在子进程里解析索引文件，只传回压缩后的映射。json.load 一直占着 GIL，放在线程里事件循环照样卡住；
+        解析时上百 MB 的内存也随子进程退出还给系统"""
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), path,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await proc.communicate()
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        if proc.returncode != 0:
+            raise RuntimeError(f"failed to parse fdroid index: {stderr.decode(errors='replace').strip()}")
+        return json.loads(stdout)
+
+    @staticmethod
+    def load_file(path: str) -> dict[str, dict[str, str]]:
+        with open(path, "rb") as f:
+            return FDroidIndex.parse(json.load(f))
+
+    @staticmethod
+    def parse(index: dict) -> dict[str, dict[str, str]]:
+        """从 index-v1 或 index-v2 中取出每个软件每个架构的最大版本编号"""
+        packages = {}
+        for package_name, versions in index.get("packages", {}).items():
+            if isinstance(versions, dict):   # index-v2
+                manifests = [v.get("manifest", {}) for v in versions.get("versions", {}).values()]
+            else:   # index-v1
+                manifests = versions
+            arch_codes: dict[str, int] = {}
+            for manifest in manifests:
+                code = manifest.get("versionCode")
+                if code is None:
+                    continue
+                for arch in manifest.get("nativecode") or (FDroidIndex.universal, ):
+                    if code > arch_codes.get(arch, -1):
+                        arch_codes[arch] = code
+            if arch_codes:
+                packages[package_name] = {arch: str(code) for arch, code in arch_codes.items()}
+        return packages
+
+    @staticmethod
+    def pick(arch_versions: dict[str, str], arch: str) -> str | None:
+        """优先用该架构专门的 apk，没有则用不含原生代码的通用 apk"""
+        return arch_versions.get(arch) or arch_versions.get(FDroidIndex.universal)
+
+
+if __name__ == "__main__":   # FDroidIndex.load 的子进程
+    json.dump(FDroidIndex.load_file(sys.argv[1]), sys.stdout, separators=(",", ":"))
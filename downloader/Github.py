@@ -1,22 +1,68 @@
 import json
-import httpx
 
-from downloader.AbstractClass import APILimitException, AbstractDownloader
+from downloader.AbstractClass import APILimitException, AbstractDownloader, NotFound, http_pool, version_cache
+from downloader.VersionCache import VersionCache
 from dataHandle import ItemInfo
 
 class GithubDownloader(AbstractDownloader):
     """专门下载 GitHub 项目 release 中的内容"""
+    api_url = "https://api.github.com"
+    graphql_batch_size = 50   # 一次 GraphQL 查询最多包含的项目数
+    valid_codes = (302, )   # release 的下载链接有效时跳转到存放文件的地址，无效时返回 404
+    # project_name -> (ETag, 标签)，带上 If-None-Match 请求，返回 304 时不消耗 API 次数
+    _etags: dict[str, tuple[str, str]] = {}
+
     @classmethod
     async def get_latest_version(cls, item_info: ItemInfo, api_token):
-        url = f"https://api.github.com/repos/{item_info.project_name}/releases/latest"
-        headers = api_token if api_token else {}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
+        # 同一个项目的所有下载项共用一次查询
+        key = ("github", item_info.project_name)
+        ttl = VersionCache.ttl_of(item_info.staleDurationDay)
+        return await version_cache.get(key, ttl, lambda: cls._get_latest_tag(item_info.project_name, api_token))
+
+    @classmethod
+    async def _get_latest_tag(cls, project_name: str, api_token):
+        url = f"{cls.api_url}/repos/{project_name}/releases/latest"
+        headers = dict(api_token) if api_token else {}
+        cached = cls._etags.get(project_name)
+        if cached:
+            headers["If-None-Match"] = cached[0]
+        response = await http_pool.client.get(url, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        if response.status_code == 404:
+            raise NotFound
         data = json.loads(response.text)
         if data.get("message"):
             # API rate limit exceeded for machine IP
             raise APILimitException()
-        return data["tag_name"].replace('/', r'%2F')
+        tag = data["tag_name"].replace('/', r'%2F')
+        if etag := response.headers.get("etag"):
+            cls._etags[project_name] = (etag, tag)
+        return tag
+
+    @classmethod
+    async def get_latest_tags(cls, project_names: list[str], api_token) -> dict[str, str]:
+        """用 GraphQL 一次查询多个项目的最新 release 标签，需要 token。查不到的项目不在返回结果里"""
+        if not api_token:
+            raise APILimitException("GraphQL API requires a token")
+        tags = {}
+        for i in range(0, len(project_names), cls.graphql_batch_size):
+            batch = project_names[i:i + cls.graphql_batch_size]
+            fields = []
+            for j, project_name in enumerate(batch):
+                owner, name = project_name.split("/", 1)
+                fields.append(f"r{j}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{ latestRelease {{ tagName }} }}")
+            query = "query { " + " ".join(fields) + " }"
+            response = await http_pool.client.post(f"{cls.api_url}/graphql", json={"query": query}, headers=dict(api_token))
+            data = response.json()
+            if response.status_code != 200 or not data.get("data"):
+                # 限额用尽或 token 无效
+                raise APILimitException(data.get("message", ""))
+            for j, project_name in enumerate(batch):
+                repository = data["data"].get(f"r{j}")
+                if repository and repository["latestRelease"]:
+                    tags[project_name] = repository["latestRelease"]["tagName"].replace('/', r'%2F')
+        return tags
 
     @classmethod
     def format_url(cls, item_info: ItemInfo, latest_version: str):
@@ -33,12 +79,6 @@ class GithubDownloader(AbstractDownloader):
         }
         return AbstractDownloader._format_url(sample_url, context)
 
-    @classmethod
-    async def is_valid_url(cls, url):
-        # 对于 GitHub，如果无效，会返回 404，有效则是 302
-        valid_codes = [302]
-        return await AbstractDownloader._is_valid_code(url, valid_codes)
-
     @classmethod
     def _is_out_of_date(cls, latest_version: str, cur: str) -> bool:
         return cur != latest_version
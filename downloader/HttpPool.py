@@ -0,0 +1,67 @@
+import asyncio
+import logging
+
+import httpx
+
+try:
+    import h2   # noqa: F401 有 h2 才能启用 HTTP/2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class UpstreamOverride(httpx.AsyncBaseTransport):
+    """把发往某些主机的请求改发到别的地址，用于基准测试时指向本地的假上游"""
+    def __init__(self, transport: httpx.AsyncBaseTransport, overrides: dict[str, str]):
+        self._transport = transport
+        self._overrides = {host: httpx.URL(target) for host, target in overrides.items()}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        target = self._overrides.get(request.url.host)
+        if target is not None:
+            request.url = request.url.copy_with(scheme=target.scheme, host=target.host, port=target.port)
+            request.headers["Host"] = request.url.netloc.decode("ascii")
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class HttpPool:
+    """进程内共享的 HTTP 连接池（保持连接，支持时用 HTTP/2），以及每个 website 的并发限制"""
+    __slots__ = ("logger", "concurrent_amount", "upstream_override", "_client", "_limiters")
+
+    def __init__(self, concurrent_amount: int, upstream_override: dict[str, str] | None = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.concurrent_amount = max(1, concurrent_amount)
+        self.upstream_override = upstream_override or {}   # 主机 -> 改发到的地址
+        self._client: httpx.AsyncClient | None = None
+        self._limiters: dict[str, asyncio.Semaphore] = {}
+
+    def open(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+            transport = httpx.AsyncHTTPTransport(http2=HTTP2, limits=limits)
+            if self.upstream_override:
+                transport = UpstreamOverride(transport, self.upstream_override)
+                self.logger.warning(f"upstream hosts overridden: {self.upstream_override}")
+            self._client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(10, connect=5))
+            self.logger.info(f"open shared http client, http2={HTTP2}")
+        return self._client
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """没有在生命周期内打开时，第一次使用则自动打开"""
+        return self.open()
+
+    def limit(self, website: str) -> asyncio.Semaphore:
+        """本进程内同一 website 同时进行的上游工作不超过 concurrent_amount_per_website，进程间由 AllocateDownloader 用租约协调"""
+        limiter = self._limiters.get(website)
+        if limiter is None:
+            limiter = self._limiters[website] = asyncio.Semaphore(self.concurrent_amount)
+        return limiter
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -5,10 +5,14 @@ from dataHandle import ItemInfo
 
 
 class Only1LinkDownloader(AbstractDownloader):
-    """专门下载只有一个下载链接的东西"""
+    """专门下载只有一个下载链接的东西。每次检查都带上次的 ETag/Last-Modified 向上游条件请求，没变则不下载；
+    上游不给校验值时下载后比较哈希，内容真的变了才替换缓存"""
+    immutable_urls = False   # 链接不变，内容会变
+    valid_codes = (302, )   # 有效时跳转到实际的文件
+
     @classmethod
     async def get_latest_version(cls, item_info: ItemInfo, api_token):
-        # 以当前日期为版本号
+        # 内容变化那天的日期作为版本号，是否有新版本由条件请求判断
         now = datetime.now()
         return now.strftime("%Y-%m-%d")
 
@@ -16,12 +20,6 @@ class Only1LinkDownloader(AbstractDownloader):
     def format_url(cls, item_info: ItemInfo, latest_version: str):
         return item_info.sample_url
 
-    @classmethod
-    async def is_valid_url(cls, url):
-        # 对于 GitHub，如果无效，会返回 404，有效则是 302
-        valid_codes = [302]
-        return await AbstractDownloader._is_valid_code(url, valid_codes)
-
     @classmethod
     def _is_out_of_date(cls, latest_version: str, cur: str) -> bool:
-        return cur != latest_version
+        return True   # 日期看不出内容有没有变，总是问上游
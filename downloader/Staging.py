@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+
+try:
+    import fcntl
+except ImportError:   # 没有 flock 的系统上只在进程内互斥
+    fcntl = None
+
+
+async def lock_file(lock_path: str, poll: float) -> int | None:
+    """等到取得 lock_path 上的 flock，返回持有锁的文件描述符，关闭即释放。没有 flock 时返回 None"""
+    if fcntl is None:
+        return None
+    while True:
+        future = asyncio.ensure_future(asyncio.to_thread(try_lock_file, lock_path))
+        try:
+            fd = await asyncio.shield(future)
+        except asyncio.CancelledError:   # 线程里可能已经取得了锁，等它结束后释放
+            future.add_done_callback(_close_locked)
+            raise
+        if fd is not None:
+            return fd
+        await asyncio.sleep(poll)
+
+
+def try_lock_file(lock_path: str) -> int | None:
+    """不等待地取得文件锁，被占用时返回 None。锁文件可能在取得锁之前被清理删掉，这时重新打开"""
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def _close_locked(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        os.close(future.result())
+
+
+class IncompleteDownload(Exception):
+    """上游的响应在声明的长度之前就结束了"""
+    pass
+
+
+class StagedDownload:
+    """暂存区里一个下载直链的部分下载。临时文件按直链命名，旁边的 .json 记着续传要用的校验值（ETag、Last-Modified、长度），
+    下载中断后保留，下次从已有的字节处用 Range/If-Range 继续"""
+    __slots__ = ("url", "key", "part_path", "meta_path", "lock_path", "etag", "last_modified", "length", "size", "hasher")
+    dirname = "staging"
+    # 同一个直链同时只能有一个下载写入暂存文件。进程内：键 -> [锁, 使用者数量]；进程间用 .lock 文件上的 flock，
+    # 不同位置的下载项可能是同一个直链，不能只靠按位置取得的租约
+    _locks: dict[str, list] = {}
+    lock_poll = 0.5   # 其他进程持有文件锁时，每隔这么久（秒）再试
+
+    def __init__(self, download_dir: str, url: str):
+        self.url = url
+        self.key = hashlib.sha256(url.encode()).hexdigest()[:32]
+        staging_dir = os.path.join(download_dir, StagedDownload.dirname)
+        self.part_path = os.path.join(staging_dir, self.key + ".part")
+        self.meta_path = os.path.join(staging_dir, self.key + ".json")
+        self.lock_path = os.path.join(staging_dir, self.key + ".lock")
+        self.etag = ""
+        self.last_modified = ""
+        self.length: int | None = None
+        self.size = 0   # 暂存文件里已有的字节数
+        self.hasher = hashlib.sha256()   # 已有字节的哈希
+
+    @asynccontextmanager
+    async def exclusive(self):
+        entry = StagedDownload._locks.setdefault(self.key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                fd = await lock_file(self.lock_path, StagedDownload.lock_poll)
+                try:
+                    yield self
+                finally:
+                    if fd is not None:   # 关闭即释放 flock
+                        os.close(fd)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del StagedDownload._locks[self.key]
+
+    @property
+    def resumable(self) -> bool:
+        """有校验值才能确认续传的是同一份内容"""
+        return self.size > 0 and bool(self.etag or self.last_modified)
+
+    @property
+    def complete(self) -> bool:
+        return self.length is not None and self.size == self.length
+
+    def load(self) -> int:
+        """读取上次留下的部分下载，并计算已有字节的哈希，返回已有的字节数；不能续传则清空"""
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            size = os.path.getsize(self.part_path)
+        except (OSError, ValueError):
+            meta, size = {}, 0
+        if meta.get("url") == self.url and (meta.get("length") is None or size <= meta["length"]):
+            self.etag, self.last_modified, self.length = meta.get("etag", ""), meta.get("last_modified", ""), meta.get("length")
+            self.size = size
+        if not self.resumable:
+            self.reset()
+            return 0
+        with open(self.part_path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                self.hasher.update(chunk)
+        return self.size
+
+    def range_headers(self) -> dict[str, str]:
+        if not self.resumable:
+            return {}
+        return {"Range": f"bytes={self.size}-", "If-Range": self.etag or self.last_modified}
+
+    def accepts(self, resp: httpx.Response) -> bool:
+        """206 且从已有字节处接着给，才能追加到暂存文件后面"""
+        if resp.status_code != 206 or not self.resumable:
+            return False
+        content_range = resp.headers.get("content-range", "")
+        return content_range.startswith(f"bytes {self.size}-")
+
+    def restart(self, resp: httpx.Response):
+        """上游给的是完整内容，清空暂存文件并记下新的校验值"""
+        self.reset()
+        if "content-encoding" not in resp.headers:   # 解压后的偏移对不上原始内容，不能续传
+            etag = resp.headers.get("etag", "")
+            self.etag = "" if etag.startswith("W/") else etag   # If-Range 只能用强校验值
+            self.last_modified = resp.headers.get("last-modified", "")
+            self.length = int(resp.headers.get("content-length", 0)) or None
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"url": self.url, "etag": self.etag, "last_modified": self.last_modified, "length": self.length}, f)
+
+    def preallocate(self):
+        """分段下载前按声明的长度预先分配暂存文件"""
+        with open(self.part_path, "r+b") as f:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, self.length)
+            else:
+                f.truncate(self.length)
+
+    def rehash(self):
+        """分段写完后，落盘并重新计算整个暂存文件的哈希"""
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        with open(self.part_path, "rb") as f:
+            os.fsync(f.fileno())
+            while chunk := f.read(1024 * 1024):
+                self.hasher.update(chunk)
+                self.size += len(chunk)
+
+    def reset(self):
+        """清空暂存文件。先删掉再新建，而不是原地截断，还打开着旧文件的读者不会读到新旧拼接的内容"""
+        self.etag, self.last_modified, self.length = "", "", None
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        open(self.part_path, "wb").close()
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def clean(download_dir: str, max_age: float):
+        """删除暂存区里很久没动过、也没有在下载的部分下载。持有文件锁时才删除，不会删掉其他进程正在写的文件"""
+        staging_dir = os.path.join(download_dir, StagedDownload.dirname)
+        if not os.path.isdir(staging_dir):
+            return
+        deadline = time.time() - max_age
+        for entry in os.scandir(staging_dir):
+            key = entry.name.partition(".")[0]
+            try:
+                if key in StagedDownload._locks or entry.stat().st_mtime >= deadline:
+                    continue
+                fd = try_lock_file(os.path.join(staging_dir, key + ".lock")) if fcntl else None
+                if fcntl and fd is None:   # 其他进程正在下载
+                    continue
+                try:
+                    os.remove(entry.path)
+                finally:
+                    if fd is not None:
+                        os.close(fd)
+            except FileNotFoundError:   # 同一个键的文件已在前面删掉
+                continue
@@ -0,0 +1,86 @@
+import asyncio
+
+import aiofiles
+
+
+class TransferFailed(Exception):
+    """上游下载中途失败，跟随读取的客户端只能拿到部分内容"""
+    pass
+
+
+class Transfer:
+    """一次正在进行的上游下载，写入缓存文件的同时，等待的客户端可以跟随读取"""
+    __slots__ = ("filename", "filepath", "part_path", "total", "written", "done", "failed", "watchers", "_changed")
+
+    def __init__(self):
+        self.filename = ""
+        self.filepath = ""    # 下载完成后文件所在的路径，暂存文件改名之前就设置
+        self.part_path = ""   # 下载过程中写入的临时文件
+        self.total = None     # 上游声明的长度，未知则为 None
+        self.written = 0
+        self.done = False
+        self.failed = False
+        self.watchers = 0   # 在等待开始或正在跟随读取的客户端数量
+        self._changed = asyncio.Event()
+
+    @property
+    def started(self) -> bool:
+        return bool(self.part_path)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def start(self, filename: str, part_path: str, total: int | None):
+        self.filename, self.part_path, self.total = filename, part_path, total
+        self._notify()
+
+    def advance(self, size: int):
+        if self.done:
+            return
+        self.written += size
+        self._notify()
+
+    def finish(self, ok: bool, filepath: str = ""):
+        if self.done:
+            return
+        self.filepath = filepath or self.filepath
+        self.done = True
+        self.failed = not ok
+        self._notify()
+
+    async def wait_started(self):
+        """等到开始写文件，或者不需要下载（没有新版本、出错）而结束"""
+        self.watchers += 1
+        try:
+            while not self.started and not self.done:
+                await self._changed.wait()
+        finally:
+            self.watchers -= 1
+
+    async def follow(self, chunk_size: int):
+        """从头读取已写入的部分，然后跟随文件增长，直到下载结束"""
+        try:
+            f = await aiofiles.open(self.part_path, 'rb')
+        except FileNotFoundError:   # 加入时临时文件已改名
+            f = await aiofiles.open(self.filepath, 'rb')
+        self.watchers += 1
+        try:
+            pos = 0
+            while True:
+                changed = self._changed
+                if self.failed:   # 暂存文件可能已经从头重写，不再读下去
+                    break
+                if pos < self.written:
+                    chunk = await f.read(min(chunk_size, self.written - pos))
+                    pos += len(chunk)
+                    yield chunk
+                elif self.done:
+                    break
+                else:
+                    await changed.wait()
+        finally:
+            self.watchers -= 1
+            await f.close()
+        if self.failed:
+            raise TransferFailed(self.filename)
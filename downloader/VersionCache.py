@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+from Metrics import VERSION_CACHE_REQUESTS
+
+
+class VersionCache:
+    """按 (website, project_name) 缓存上游查到的最新版本信息，所有下载器共用。
+    同一个项目的多个平台、架构，以及指向同一项目的多个下载项，只需查一次上游"""
+    __slots__ = ("logger", "_entries", "_inflight")
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._entries: dict[Hashable, tuple[float, Any]] = {}   # 键 -> (过期时刻, 值)
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+
+    @staticmethod
+    def ttl_of(stale_duration_day: float) -> float:
+        """缓存时长取下载项过期时长的 1/24，即每过期一天缓存一小时"""
+        return stale_duration_day * 3600
+
+    def peek(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def put(self, key: Hashable, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+
+    async def get(self, key: Hashable, ttl: float, fetch: Callable[[], Awaitable]):
+        """命中则直接返回；否则调用 fetch，同一个键同时只有一个 fetch 在进行。键的第一项是 website"""
+        value = self.peek(key)
+        if value is not None:
+            VERSION_CACHE_REQUESTS.labels(key[0], "hit").inc()
+            return value
+        future = self._inflight.get(key)
+        if future is None:
+            VERSION_CACHE_REQUESTS.labels(key[0], "miss").inc()
+            future = self._inflight[key] = asyncio.ensure_future(self._fetch(key, ttl, fetch))
+        else:
+            VERSION_CACHE_REQUESTS.labels(key[0], "joined").inc()
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key: Hashable, ttl: float, fetch: Callable[[], Awaitable]):
+        try:
+            value = await fetch()
+            self.put(key, value, ttl)
+            return value
+        finally:
+            del self._inflight[key]
@@ -1,4 +1,5 @@
-from .AbstractClass import APILimitException, NotFound
+from .AbstractClass import APILimitException, NotFound, http_pool, version_cache
+from .Transfer import Transfer, TransferFailed
 from .Github import GithubDownloader
 from .FDroid import FDroidDownloader
 from .Only1Link import Only1LinkDownloader
@@ -1,25 +1,86 @@
+import asyncio
+import logging
 import os
+import signal
+from email.utils import formatdate, parsedate_to_datetime
+from contextlib import asynccontextmanager
 from pathlib import Path
+from urllib.parse import quote
 from enum import Enum
 from typing import Annotated, Literal, Optional
 
 from fastapi import FastAPI, Request, Query, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST
+from pydantic import BaseModel, Field
 
 import preprocess
 from AutoCallerFactory import AllocateDownloader
+from DeltaBuilder import DeltaBuilder
+from IndexPage import IndexPage, ManifestPage
+from Metrics import BUFFER_BYTES, DELTA_REQUESTS, LoopLagMonitor, generate_metrics, mark_process_exited, prepare_multiprocess_dir, slow_request_log
+from RefreshScheduler import RefreshScheduler
+from TarStream import TarStream
 from dataHandle import ItemLocation
-
-app = FastAPI()
+from downloader import Transfer, http_pool
+from downloader.AbstractClass import AbstractDownloader
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop_lag_monitor.start()
+    http_pool.open()
+    if preprocess.config.background_refresh:
+        refresh_scheduler.start()
+    if preprocess.config.delta_updates:
+        delta_builder.start()
+    sync_task = asyncio.create_task(sync_catalog())
+    try:   # 单进程时 kill -HUP 立即重载下载项；uvicorn --workers 的主进程收到 HUP 会重启各进程
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload_items()))
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        pass
+    yield
+    sync_task.cancel()
+    await refresh_scheduler.stop()
+    await delta_builder.stop()
+    await http_pool.aclose()
+    await preprocess.data.flush_accesses()
+    await preprocess.data.release_lease()
+    await loop_lag_monitor.stop()
+    preprocess.data.shutdown()
+    mark_process_exited()
+
+async def sync_catalog():
+    """定期读入其他进程对缓存的改动，下载项配置文件改动后增量重载；同时写回本进程的访问记录，
+    任何进程淘汰时都按所有进程的访问挑选。没有改动时每次只是一条 PRAGMA 和一次 stat"""
+    while True:
+        await asyncio.sleep(preprocess.config.catalog_sync_seconds)
+        try:
+            if await preprocess.data.items_changed():
+                await reload_items()
+            await preprocess.data.flush_accesses()
+            await preprocess.data.sync()
+        except Exception as e:
+            logger.error(f"failed to sync catalog: {e}")
+
+async def reload_items():
+    try:
+        await preprocess.data.reload_items()
+    except Exception as e:   # 配置有误时保留原来的下载项
+        logger.error(f"failed to reload items: {e}")
+
+app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory='templates')
 allocate_downloader = AllocateDownloader(preprocess.data, preprocess.config.temp_download_dir)
-
+refresh_scheduler = RefreshScheduler(preprocess.data, allocate_downloader)
+delta_builder = DeltaBuilder(preprocess.data, preprocess.config.temp_download_dir, preprocess.config.delta_level, preprocess.config.delta_max_ratio)
+index_page = IndexPage(templates.get_template("index.html"))
+manifest_page = ManifestPage()
+logger = logging.getLogger("main")
+loop_lag_monitor = LoopLagMonitor(logger, preprocess.config.loop_lag_warning_seconds)
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    context = {"categories": preprocess.data.categories}
-    return templates.TemplateResponse(request=request, name="index.html", context=context)
+    return await index_page.response(request, preprocess.data)
 
 
 class ItemLocationFilter(BaseModel):
@@ -31,15 +92,126 @@ class ItemLocationFilter(BaseModel):
         return ItemLocation(self.name, self.platform, self.arch)
 
 
-@app.get("/download/")
-async def download(params: Annotated[ItemLocationFilter, Query()]):
-    situation = preprocess.data.get_item_situation(params.to_item_location())
+class DownloadParams(ItemLocationFilter):
+    # 客户端已有的版本，有从它到当前版本的补丁时只返回补丁
+    from_version: Optional[str] = Field(None, max_length=128)
+
+
+@app.api_route("/download/", methods=["GET", "HEAD"])
+async def download(request: Request, params: Annotated[DownloadParams, Query()]):
+    item_location = params.to_item_location()
+    with slow_request_log(logger, f"{request.method} {tuple(item_location)}", preprocess.config.slow_request_seconds):
+        return await get_download(request, item_location, params.from_version)
+
+async def get_download(request: Request, item_location: ItemLocation, from_version: str | None = None) -> Response:
+    situation = preprocess.data.get_item_situation(item_location)
     if not situation:
         raise HTTPException(status_code=404, detail="Resource not found")
-    fp = await allocate_downloader.get_file(situation)
+    if request.method == "HEAD":   # 用来检查有没有更新，只按缓存回答，不为此下载整个文件
+        fp, filename = await preprocess.data.get_and_check_path_from_db(item_location)
+        if not fp:
+            raise HTTPException(status_code=503, detail="Resource not cached yet", headers={"Retry-After": "60"})
+        if AllocateDownloader.is_stale(situation):   # 过期则在后台检查新版本，之后的请求就能看到
+            allocate_downloader.check_later(situation)
+    elif preprocess.config.stream_through:
+        fp, filename, transfer = await allocate_downloader.get_file_or_transfer(situation)
+        if transfer:   # 首次下载时，边从上游下载边发给客户端
+            return stream_transfer(transfer)
+    else:
+        fp, filename = await allocate_downloader.get_file(situation)
     if not fp:
         raise HTTPException(status_code=503, detail="Resource temporarily unavailable")
-    return FileResponse(path=fp, filename=os.path.basename(fp))
+    if from_version:
+        delta = await preprocess.data.find_delta(item_location, from_version)
+        DELTA_REQUESTS.labels("patch" if delta else "full").inc()
+        if delta:
+            patch_path, patch_hash, to_hash = delta
+            headers = {"X-Delta-From": quote(from_version), "X-Target-SHA256": to_hash}
+            return await file_response(request, patch_path, f"{filename}.zst", patch_hash, preprocess.data.get_last_modified(item_location),
+                                       headers, "application/zstd")
+    return await file_response(request, fp, filename, preprocess.data.get_digest(item_location), preprocess.data.get_last_modified(item_location))
+
+# 同一个链接的内容会随版本变化，客户端每次都要用 ETag 校验
+download_cache_control = "no-cache"
+
+async def file_response(request: Request, fp: str, filename: str, digest: str, last_modified: int,
+                        extra_headers: dict[str, str] | None = None, media_type: str | None = None) -> Response:
+    """ETag 取内容的哈希，Last-Modified 取这一项更新的时间，没有记录时才用文件的修改时间；Range 和 If-Range 由 FileResponse 处理"""
+    stat_result = await asyncio.to_thread(os.stat, fp)
+    last_modified = last_modified or int(stat_result.st_mtime)
+    headers = {"Cache-Control": download_cache_control, "Last-Modified": formatdate(last_modified, usegmt=True), **(extra_headers or {})}
+    if digest:
+        headers["ETag"] = f'"{digest}"'
+    response = FileResponse(path=fp, filename=filename, headers=headers, stat_result=stat_result, media_type=media_type)
+    if not_modified(request, response.headers["etag"], last_modified):
+        return Response(status_code=304, headers={k: response.headers[k] for k in ("etag", "last-modified", "cache-control")})
+    return response
+
+def not_modified(request: Request, etag: str, last_modified: int) -> bool:
+    """If-None-Match 优先，没有时才看 If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= last_modified
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def stream_transfer(transfer: Transfer) -> StreamingResponse:
+    headers = {"Content-Disposition": f"attachment; filename*=utf-8''{quote(transfer.filename)}"}
+    if transfer.total is not None:
+        headers["Content-Length"] = str(transfer.total)
+    return StreamingResponse(transfer.follow(AbstractDownloader.chunk_size), media_type="application/octet-stream", headers=headers)
+
+@app.get("/api/manifest")
+async def manifest(request: Request):
+    """所有下载项已缓存的版本、大小和 sha256，带 If-None-Match 请求时没有变化回 304"""
+    return await manifest_page.response(request, preprocess.data)
+
+
+class BatchRequest(BaseModel):
+    items: list[ItemLocationFilter] = Field(min_length=1, max_length=64)
+
+
+@app.post("/api/batch")
+async def batch(request: Request, body: BatchRequest):
+    """一次取多个下载项：并发准备好所有文件，再拼成一个 tar 流式返回。有一项不存在或取不到则整个请求失败"""
+    item_locations = list(dict.fromkeys(item.to_item_location() for item in body.items))
+    with slow_request_log(logger, f"batch of {len(item_locations)}", preprocess.config.slow_request_seconds):
+        situations = []
+        for item_location in item_locations:
+            situation = preprocess.data.get_item_situation(item_location)
+            if not situation:
+                raise HTTPException(status_code=404, detail=f"Resource not found: {'/'.join(item_location)}")
+            situations.append(situation)
+        files = await asyncio.gather(*(allocate_downloader.get_file(situation) for situation in situations))
+        missing = ["/".join(loc) for loc, (fp, _) in zip(item_locations, files) if not fp]
+        if missing:
+            raise HTTPException(status_code=503, detail=f"Resource temporarily unavailable: {', '.join(missing)}")
+        tar = TarStream()
+        try:
+            for fp, filename in files:
+                await tar.add(fp, filename)
+        except OSError:
+            await tar.aclose()
+            raise HTTPException(status_code=503, detail="Resource temporarily unavailable")
+    headers = {"Content-Length": str(tar.length), "Content-Disposition": 'attachment; filename="updatefetch.tar"'}
+    return StreamingResponse(tar.iterate(AbstractDownloader.chunk_size), media_type="application/x-tar", headers=headers)
+
+@app.get("/metrics")
+async def metrics():
+    # 多进程模式不支持 set_function，抓取时再设置缓存大小；多进程时要读各进程的指标文件，不在事件循环里生成
+    BUFFER_BYTES.set(await preprocess.data.get_buf_size())
+    return Response(await asyncio.to_thread(generate_metrics), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/api/refresh-status")
+async def refresh_status():
+    """后台刷新里每个下载项的下次检查时间和上次结果。多个进程时只有 leading 的那个在刷新"""
+    return {"enabled": preprocess.config.background_refresh, "leading": refresh_scheduler.leading, "items": refresh_scheduler.report()}
 
 @app.get("/favicon.ico")
 async def favicon():
@@ -64,4 +236,6 @@ async def static_from_root(file: AdditionalPage):
 
 if __name__ == '__main__':
     import uvicorn
-    uvicorn.run(app, host='0.0.0.0', port=7500)
+    if preprocess.config.workers > 1 and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        prepare_multiprocess_dir(os.path.join(preprocess.config.temp_download_dir, "metrics"))
+    uvicorn.run("main:app", host='0.0.0.0', port=7500, workers=preprocess.config.workers)
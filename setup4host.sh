@@ -2,6 +2,7 @@
 # setup4host.sh - set up virtual environment, install dependencies and create systemd file
 
 program_name="updatefetch"   # 不能有空格等特殊符号
+workers=${UF_WORKERS:-1}   # uvicorn 的进程数，进程间通过数据库协调
 current_uid=$(id -u)
 current_dir=$(pwd)
 
@@ -36,9 +37,11 @@ WorkingDirectory=${current_dir}
 User=${current_uid}
 Group=${current_uid}
 Type=simple
-ExecStart=${current_dir}/.env/bin/uvicorn main:app --host 0.0.0.0 --port 8679
-ExecStop=/bin/kill -s HUP $MAINPID
+ExecStartPre=/bin/rm -rf ${current_dir}/temp_download/metrics
+ExecStartPre=/bin/mkdir -p ${current_dir}/temp_download/metrics
+ExecStart=${current_dir}/.env/bin/uvicorn main:app --host 0.0.0.0 --port 8679 --workers ${workers}
 Environment=PYTHONUNBUFFERED=1
+Environment=PROMETHEUS_MULTIPROC_DIR=${current_dir}/temp_download/metrics
 RestartSec=15
 Restart=on-failure
 
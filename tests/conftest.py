@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+# 导入 downloader 包时会读取配置文件，测试用临时目录里的示例配置，日志只输出到控制台
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_tmp = tempfile.mkdtemp(prefix="uf-test-")
+with open(os.path.join(_tmp, "pgm_config.yaml"), "w", encoding="utf-8") as f:
+    f.write(f"""\
+program_configuration: true
+items_file: {os.path.join(_tmp, "items.yaml")}
+temp_download_dir: {os.path.join(_tmp, "temp_download")}
+data_dir: {_tmp}
+logging:
+  version: 1
+  disable_existing_loggers: False
+""")
+os.environ.setdefault("UPDATEFETCH_CONFIG_FILE", os.path.join(_root, "examples", "config.yaml"))
+os.environ.setdefault("UPDATEFETCH_PGM_CONFIG_FILE", os.path.join(_tmp, "pgm_config.yaml"))
+sys.path.insert(0, _root)
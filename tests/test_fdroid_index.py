@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+import httpx
+
+from downloader.FDroidIndex import FDroidIndex
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+INDEX_V1 = os.path.join(FIXTURES, "fdroid-index-v1.json")
+INDEX_V2 = os.path.join(FIXTURES, "fdroid-index-v2.json")
+
+
+class FakePool:
+    """只提供 client，请求由 handler 回答"""
+    def __init__(self, handler):
+        self.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_parse_index_v1():
+    assert FDroidIndex.load_file(INDEX_V1) == {
+        "org.example.multi": {"armeabi-v7a": "12", "": "11", "arm64-v8a": "10", "x86": "9"},
+        "org.example.pure": {"": "5"},
+        "org.example.native": {"arm64-v8a": "7"},
+    }
+
+
+def test_parse_index_v2():
+    assert FDroidIndex.load_file(INDEX_V2) == {
+        "org.example.multi": {"arm64-v8a": "20", "": "19", "armeabi-v7a": "21", "x86_64": "21"},
+        "org.example.pure": {"": "4"},
+    }
+
+
+def test_pick_prefers_arch_then_universal():
+    packages = FDroidIndex.load_file(INDEX_V1)
+    assert FDroidIndex.pick(packages["org.example.multi"], "arm64-v8a") == "10"
+    assert FDroidIndex.pick(packages["org.example.multi"], "x86_64") == "11"
+    assert FDroidIndex.pick(packages["org.example.pure"], "arm64-v8a") == "5"
+    assert FDroidIndex.pick(packages["org.example.native"], "x86") is None
+
+
+def test_get_package_from_local_index():
+    index = FDroidIndex(INDEX_V1, None)
+
+    async def run():
+        return await index.get_package("org.example.multi", 60), await index.get_package("org.example.missing", 60)
+    multi, missing = asyncio.run(run())
+    assert multi == {"armeabi-v7a": "12", "": "11", "arm64-v8a": "10", "x86": "9"}
+    assert missing is None
+
+
+def test_workers_share_cached_index(tmp_path):
+    with open(INDEX_V2, "rb") as f:
+        body = f.read()
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.headers.get("if-none-match") == '"v2"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=body, headers={"etag": '"v2"'})
+
+    cache_path = str(tmp_path / "fdroid-index.json")
+    url = "https://f-droid.example/repo/index-v2.json"
+
+    async def run():
+        first = FDroidIndex(url, FakePool(handler), cache_path)
+        second = FDroidIndex(url, FakePool(handler), cache_path)
+        assert await first.get_package("org.example.pure", 3600) == {"": "4"}
+        # 另一个进程在有效期内直接读缓存文件，不再请求上游
+        assert await second.get_package("org.example.multi", 3600) == first.packages["org.example.multi"]
+        assert len(requests) == 1
+        # 过期后带着缓存里的 ETag 做条件请求
+        await second.refresh(0)
+        assert requests[-1].headers["if-none-match"] == '"v2"'
+        assert second.packages == first.packages
+    asyncio.run(run())